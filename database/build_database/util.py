@@ -1,11 +1,19 @@
 import psycopg2
 from textwrap import dedent
 
-# note: con and cur stay open until the module goes out of scope
+# note: con and cur are created the first time a query is executed (so this module can be
+# imported without access to the database), then stay open until the module goes out of scope
 switch_host = 'redr.eng.hawaii.edu'
 switch_db = 'switch'
-con = psycopg2.connect(database=switch_db, host=switch_host)
-cur = con.cursor()    
+con = None
+cur = None
+
+def connect():
+    global con, cur
+    if con is None:
+        con = psycopg2.connect(database=switch_db, host=switch_host)
+        cur = con.cursor()
+    return con
 
 def execute(query, *args, **kwargs):
     return _execute(query, False, *args, **kwargs)
@@ -14,6 +22,7 @@ def executemany(query, *args, **kwargs):
     return _execute(query, True, *args, **kwargs)
 
 def _execute(query, many, *args, **kwargs):
+    connect()
     q = dedent(query)
     func = cur.executemany if many else cur.execute
     print q
@@ -10,6 +10,7 @@
 
 import os
 from pyomo.environ import *
+from slice_set import slice_set
 
 inf = float('inf')
 
@@ -59,6 +60,10 @@ def define_components(m):
     # of binary variables and constraining the actual decisions to match the binary
     # version if some flag is set in the data.
 
+    # all the supply tiers available in each period (across all markets)
+    m.RFM_SUPPLY_TIERS_IN_PERIOD = Set(m.PERIODS, dimen=3, 
+        initialize=slice_set('RFM_SUPPLY_TIERS', index=(1,)))
+
     m.RFM_Fixed_Costs_Annual = Expression(
         m.PERIODS,
         rule=lambda m, p: sum(
@@ -68,8 +73,7 @@ def define_components(m):
                 else m.rfm_supply_tier_fixed_cost[rfm_st]
                     * m.RFMSupplyTierActivate[rfm_st] * m.rfm_supply_tier_limit[rfm_st]
             )
-            for r in m.REGIONAL_FUEL_MARKET
-                for rfm_st in m.RFM_P_SUPPLY_TIERS[r, p]))
+            for rfm_st in m.RFM_SUPPLY_TIERS_IN_PERIOD[p]))
 
     m.cost_components_annual.append('RFM_Fixed_Costs_Annual')
 
@@ -1,6 +1,8 @@
+import os
 from pprint import pprint
 from pyomo.environ import *
 import switch_mod.utilities as utilities
+from slice_set import slice_set
 
 
 def define_components(m):
@@ -24,6 +26,34 @@ def define_components(m):
         return m.rps_target[latest_target]
     m.rps_target_for_period = Param(m.PERIODS, initialize=rps_target_for_period_rule)
 
+    # Sparse index sets, so RPS_Enforce (and reporting code) only visit the projects 
+    # and timepoints that are actually active in each period. Each of these is built
+    # in a single pass through the dispatch points (see slice_set.py).
+    # note: all non-fuel energy sources are RPS-eligible
+
+    # all timepoints when each project is active
+    m.ACTIVE_TIMEPOINTS_FOR_PROJECT = Set(m.PROJECTS, within=m.TIMEPOINTS, 
+        initialize=slice_set('PROJ_DISPATCH_POINTS', index=(0,), value=(1,)))
+    # all (project, timepoint) dispatch points in each period
+    m.PROJ_DISPATCH_POINTS_IN_PERIOD = Set(m.PERIODS, dimen=2, 
+        initialize=slice_set('PROJ_DISPATCH_POINTS', index=lambda m, p, t: m.tp_period[t]))
+    # projects that can use each fuel or non-fuel energy source, and are active in each period
+    m.PROJECTS_BY_FUEL_IN_PERIOD = Set(m.FUELS, m.PERIODS, within=m.PROJECTS, 
+        initialize=slice_set('PROJ_FUEL_DISPATCH_POINTS', 
+            index=lambda m, p, t, f: (f, m.tp_period[t]), value=(0,)))
+    m.PROJECTS_BY_NON_FUEL_ENERGY_SOURCE_IN_PERIOD = Set(m.NON_FUEL_ENERGY_SOURCES, m.PERIODS, 
+        within=m.PROJECTS, 
+        initialize=slice_set('PROJ_DISPATCH_POINTS', 
+            index=lambda m, p, t: (m.proj_non_fuel_energy_source[p], m.tp_period[t]), value=(0,),
+            filter=lambda m, p, t: p in m.NON_FUEL_BASED_PROJECTS))
+    # RPS-eligible dispatch in each period, as (project, timepoint, fuel) or (project, timepoint)
+    m.RPS_FUEL_DISPATCH_POINTS = Set(m.PERIODS, dimen=3, 
+        initialize=slice_set('PROJ_FUEL_DISPATCH_POINTS', 
+            index=lambda m, p, t, f: m.tp_period[t], filter=lambda m, p, t, f: m.f_rps_eligible[f]))
+    m.RPS_NON_FUEL_DISPATCH_POINTS = Set(m.PERIODS, dimen=2, 
+        initialize=slice_set('PROJ_DISPATCH_POINTS', 
+            index=lambda m, p, t: m.tp_period[t], filter=lambda m, p, t: p in m.NON_FUEL_BASED_PROJECTS))
+
     # Note: this rule ignores pumped hydro, so it could be gamed by producing extra 
     # RPS-eligible power and burning it off in storage losses; on the other hand, 
     # it also neglects the (small) contribution from net flow of pumped hydro projects.
@@ -31,19 +61,9 @@ def define_components(m):
     # sum(getattr(m, component)[lz, t] for lz in m.LOAD_ZONES) for component in m.LZ_Energy_Components_Produce)
     m.RPS_Enforce = Constraint(m.PERIODS, rule=lambda m, per:
         ( # RPS-eligible sources
-            sum(
-                get(m.DispatchProjByFuel, (p, t, f), 0.0) 
-                    for f in m.FUELS if f in m.RPS_ENERGY_SOURCES
-                        for p in m.PROJECTS_BY_FUEL[f]
-                            for t in m.PERIOD_TPS[per]  # could be accelerated a bit if we had m.ACTIVE_PERIODS_FOR_PROJECT[p]
-            )
+            sum(m.DispatchProjByFuel[p, t, f] for (p, t, f) in m.RPS_FUEL_DISPATCH_POINTS[per])
             +
-            sum(
-                get(m.DispatchProj, (p, t), 0.0)
-                    for f in m.NON_FUEL_ENERGY_SOURCES if f in m.RPS_ENERGY_SOURCES
-                        for p in m.PROJECTS_BY_NON_FUEL_ENERGY_SOURCE[f]
-                            for t in m.PERIOD_TPS[per]
-            )
+            sum(m.DispatchProj[p, t] for (p, t) in m.RPS_NON_FUEL_DISPATCH_POINTS[per])
             -
             # assume DumpPower is curtailed renewable energy
             sum(m.DumpPower[lz, tp] for lz in m.LOAD_ZONES for tp in m.PERIOD_TPS[per])
@@ -51,7 +71,7 @@ def define_components(m):
         >=
         m.rps_target_for_period[per]
         # all energy sources
-        * sum(get(m.DispatchProj, (p, t), 0.0) for p in m.PROJECTS for t in m.PERIOD_TPS[per])
+        * sum(m.DispatchProj[p, t] for (p, t) in m.PROJ_DISPATCH_POINTS_IN_PERIOD[per])
     )
 
 def load_inputs(m, switch_data, inputs_dir):
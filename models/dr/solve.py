@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 
-import sys, os, time, traceback, fcntl
+import sys, os, time, traceback
 
 from pyomo.environ import *
 from pyomo.opt import SolverFactory, SolverStatus, TerminationCondition
@@ -31,6 +31,12 @@ add_relative_path('.') # components for this particular study
 
 add_relative_path('..', 'pumped_hydro') # components reused from the pumped_hydro study
 
+add_relative_path('..', 'rps') # shared scenario job queue
+import job_queue
+
+# database used to keep track of queued, running and completed scenarios
+queue_file = 'scenario_queue.sqlite'
+
 opt = SolverFactory("cplex", solver_io="nl")
 # tell cplex to find an irreducible infeasible set (and report it)
 opt.options['iisfind'] = 1
@@ -95,11 +101,14 @@ def main():
                 args[arg] = True
         # if they list scenario name(s) on the command line, only run those
         if len(scenarios_to_do) == 0 or args['tag'] in scenarios_to_do:
-            if scenario_already_run(tag):
-                print 'scenario {t} already completed; skipping.'.format(t=tag)
+            tag = args['tag']
+            if scenario_already_run(tag, args):
+                print 'scenario {t} already completed or running; skipping.'.format(t=tag)
             else:
                 print 'arguments: {}'.format(args)
-                solve(**args)
+                # renew the lease while solving, then record whether the scenario succeeded
+                with job_queue.running_job(queue_file, tag):
+                    solve(**args)
 
 
 
@@ -229,21 +238,13 @@ def solve(
         write_results(switch_instance, tag=t+'dr_share_'+str(dr_share))
 
 
-def scenario_already_run(scenario):
-    """Add the specified scenario to the list in completed_scenarios.txt. Return False if it wasn't there already."""
-    with open('completed_scenarios.txt', 'a+') as f:
-        # wait for exclusive access to the list (to avoid writing the same scenario twice in a race condition)
-        fcntl.flock(f, fcntl.LOCK_EX)
-        # file starts with pointer at end; move to start
-        f.seek(0, 0)                    
-        if scenario + '\n' in f:
-            already_run = True
-        else:
-            already_run = False
-            # append name to the list (will always go at end, because file was opened in 'a' mode)
-            f.write(scenario + '\n')
-        fcntl.flock(f, fcntl.LOCK_UN)
-    return already_run
+def scenario_already_run(scenario, args=None):
+    """Claim the specified scenario in the job queue. Return True (without claiming it) 
+    if it has already been completed or is currently running in another process."""
+    con = job_queue.connect(queue_file)
+    claimed = job_queue.claim_job(con, scenario, args)
+    con.close()
+    return not claimed
 
 
 def setup_results_dir():
@@ -318,6 +319,14 @@ def write_results(m, tag=None):
             for p in m.PROJECTS
         )
     )
+    # use the sparse project lists from the rps module if available
+    # (only the projects active in the current period)
+    if hasattr(m, 'PROJECTS_BY_FUEL_IN_PERIOD'):
+        fuel_projects = lambda f, t: m.PROJECTS_BY_FUEL_IN_PERIOD[f, m.tp_period[t]]
+        non_fuel_projects = lambda s, t: m.PROJECTS_BY_NON_FUEL_ENERGY_SOURCE_IN_PERIOD[s, m.tp_period[t]]
+    else:
+        fuel_projects = lambda f, t: m.PROJECTS_BY_FUEL[f]
+        non_fuel_projects = lambda s, t: m.PROJECTS_BY_NON_FUEL_ENERGY_SOURCE[s]
     util.write_table(
         m, m.LOAD_ZONES, m.TIMEPOINTS, 
         output_file=os.path.join(output_dir, "energy_sources{t}.txt".format(t=t)), 
@@ -332,17 +341,17 @@ def write_results(m, tag=None):
         values=lambda m, z, t: 
             (z, m.tp_timestamp[t]) 
             +tuple(
-                sum(get(m.DispatchProjByFuel, (p, t, f), 0.0) for p in m.PROJECTS_BY_FUEL[f])
+                sum(get(m.DispatchProjByFuel, (p, t, f), 0.0) for p in fuel_projects(f, t))
                 for f in m.FUELS
             )
             +tuple(
-                sum(get(m.DispatchProj, (p, t), 0.0) for p in m.PROJECTS_BY_NON_FUEL_ENERGY_SOURCE[s])
+                sum(get(m.DispatchProj, (p, t), 0.0) for p in non_fuel_projects(s, t))
                 for s in m.NON_FUEL_ENERGY_SOURCES
             )
             +tuple(
                 sum(
                     get(m.DispatchUpperLimit, (p, t), 0.0) - get(m.DispatchProj, (p, t), 0.0) 
-                    for p in m.PROJECTS_BY_NON_FUEL_ENERGY_SOURCE[s]
+                    for p in non_fuel_projects(s, t)
                 )
                 for s in m.NON_FUEL_ENERGY_SOURCES
             )
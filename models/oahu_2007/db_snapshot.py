@@ -0,0 +1,196 @@
+#!/usr/bin/python
+
+# Makes a local snapshot of the parts of the switch database that get_scenario_data.py uses,
+# so inputs can be generated without access to the postgres server (e.g., on compute nodes).
+#
+# To create a snapshot with the data for one or more time samples:
+#     python db_snapshot.py switch_snapshot.sqlite 2007 [<time_sample> ...]
+# To use it, set the SWITCH_DB_SNAPSHOT environment variable before running get_scenario_data.py:
+#     SWITCH_DB_SNAPSHOT=switch_snapshot.sqlite python get_scenario_data.py
+#
+# The snapshot is an SQLite database. The queries in get_scenario_data.py are written for
+# postgres, so they are translated before they are run on the snapshot (see translate_query()).
+# This only covers the postgres features those queries use; other queries may need more
+# translations.
+
+import os, sys, re, time, datetime, sqlite3
+from decimal import Decimal
+from textwrap import dedent
+
+# tables that are copied into the snapshot, with a filter to select the rows that are needed
+# for the chosen time samples (None to copy the whole table)
+hourly_filter = "date_time IN (SELECT date_time FROM study_hour WHERE time_sample IN %(time_samples)s)"
+snapshot_tables = [
+    ('study_periods', "time_sample IN %(time_samples)s"),
+    ('study_date', "time_sample IN %(time_samples)s"),
+    ('study_hour', "time_sample IN %(time_samples)s"),
+    ('load_zone', None),
+    ('system_load', hourly_filter),
+    ('system_load_scale', None),
+    ('fuel_costs', None),
+    ('generator_costs', None),
+    ('connect_cost', None),
+    ('max_capacity', None),
+    ('existing_plants', None),
+    ('existing_plants_gen_tech', None),
+    ('cap_factor', hourly_filter),
+    ('existing_plants_cap_factor', hourly_filter),
+]
+
+# columns that get indexes in the snapshot (if a table has them), to speed up joins
+index_columns = ['time_sample', 'study_date', 'date_time', 'technology', 'project_id', 'load_zone']
+
+# number of rows to transfer at a time
+batch_size = 10000
+
+# sqlite column types for postgres type codes (others are stored as text)
+# (int2, int4, int8, oid; float4, float8, numeric; bool)
+sqlite_types = dict(
+    [(t, 'INTEGER') for t in [20, 21, 23, 26]]
+    + [(t, 'REAL') for t in [700, 701, 1700]]
+    + [(16, 'INTEGER')]
+)
+
+def create_snapshot(pg_con, snapshot_file, time_samples):
+    """Copy the tables needed for the specified time samples from the postgres
+    connection pg_con into a new SQLite database in snapshot_file."""
+    tmp_file = snapshot_file + '.tmp'
+    if os.path.exists(tmp_file):
+        os.remove(tmp_file)
+    con = sqlite3.connect(tmp_file)
+    con.execute("CREATE TABLE snapshot_info (name TEXT PRIMARY KEY, value TEXT);")
+    con.executemany("INSERT INTO snapshot_info VALUES (?, ?);", [
+        ('created', datetime.datetime.now().isoformat()),
+        ('time_samples', ' '.join(time_samples)),
+    ])
+    for (table, row_filter) in snapshot_tables:
+        copy_table(pg_con, con, table, row_filter, dict(time_samples=tuple(time_samples)))
+    con.commit()
+    con.close()
+    # note: the snapshot is only moved into place once it is complete
+    if os.name == 'nt' and os.path.exists(snapshot_file):
+        os.remove(snapshot_file)
+    os.rename(tmp_file, snapshot_file)
+
+def copy_table(pg_con, con, table, row_filter, arguments):
+    print "Copying {t} ...".format(t=table),
+    sys.stdout.flush()
+    start = time.time()
+    query = 'SELECT * FROM "{t}"'.format(t=table)
+    if row_filter is not None:
+        query += ' WHERE ' + row_filter
+    # note: a named (server-side) cursor transfers the rows in batches, so large
+    # tables like cap_factor don't have to fit in memory
+    cur = pg_con.cursor(name='snapshot_' + table)
+    cur.itersize = batch_size
+    cur.execute(query, arguments)
+    first = cur.fetchmany(batch_size)
+    columns = [(d[0], sqlite_types.get(d[1], 'TEXT')) for d in cur.description]
+    con.execute('CREATE TABLE "{t}" ({c});'.format(
+        t=table, c=', '.join('"{n}" {ty}'.format(n=n, ty=ty) for (n, ty) in columns)
+    ))
+    insert = 'INSERT INTO "{t}" VALUES ({p});'.format(t=table, p=', '.join('?' for c in columns))
+    n_rows = 0
+    rows = first
+    while len(rows) > 0:
+        con.executemany(insert, [[sqlite_value(v) for v in r] for r in rows])
+        n_rows += len(rows)
+        rows = cur.fetchmany(batch_size)
+    cur.close()
+    pg_con.rollback()
+    for (n, ty) in columns:
+        if n in index_columns:
+            con.execute('CREATE INDEX "{t}_{n}" ON "{t}" ("{n}");'.format(t=table, n=n))
+    print "{n} rows, time taken: {dur:.2f}s".format(n=n_rows, dur=time.time()-start)
+
+def sqlite_value(v):
+    """Convert a value from postgres into a form that can be stored in SQLite."""
+    if isinstance(v, Decimal):
+        return float(v)
+    elif isinstance(v, datetime.datetime):
+        # note: time zones are dropped, so all timestamps are in the time zone of the
+        # postgres session, and they can be compared and joined as text
+        return v.strftime('%Y-%m-%d %H:%M:%S')
+    elif isinstance(v, (datetime.date, datetime.time)):
+        return v.isoformat()
+    elif isinstance(v, (list, dict)):
+        return repr(v)
+    return v
+
+#########################
+# translation of postgres queries for use with the snapshot
+
+# regular expressions and replacements for the postgres features used in get_scenario_data.py
+# (applied in order)
+translations = [
+    # <timestamp> + (<n>) * interval '1 year'
+    (r"([\w.]+)\s*\+\s*\((.+?)\)\s*\*\s*interval\s+'1 year'", r"add_years(\1, \2)"),
+    # extract(year from <timestamp>)
+    (r"extract\(\s*year\s+from\s+([\w.]+)\s*\)", r"CAST(strftime('%Y', \1) AS INTEGER)"),
+]
+
+def translate_query(query, arguments):
+    """Convert a postgres query with psycopg2-style %(name)s arguments into an SQLite
+    query with named parameters. Returns (query, parameters)."""
+    params = {}
+    def param(match):
+        name = match.group(1)
+        v = arguments[name]
+        if isinstance(v, (tuple, list)):
+            # psycopg2 converts tuples into lists of values, e.g., for "x IN %(tuple)s"
+            keys = ['{n}_{i}'.format(n=name, i=i) for i in range(len(v))]
+            params.update(zip(keys, v))
+            return '(' + ', '.join(':' + k for k in keys) + ')'
+        params[name] = v
+        return ':' + name
+    query = re.sub(r'%\((\w+)\)s', param, dedent(query)).replace('%%', '%')
+    for (pattern, replacement) in translations:
+        query = re.sub(pattern, replacement, query, flags=re.IGNORECASE)
+    return (query, params)
+
+def parse_timestamp(ts):
+    return datetime.datetime.strptime(ts[:19], '%Y-%m-%d %H:%M:%S')
+
+def add_years(ts, n):
+    if ts is None or n is None:
+        return None
+    t = parse_timestamp(ts)
+    try:
+        t = t.replace(year=t.year + int(n))
+    except ValueError:
+        # Feb. 29 in a non-leap year
+        t = t.replace(year=t.year + int(n), day=28)
+    return t.strftime('%Y-%m-%d %H:%M:%S')
+
+# postgres to_char() format codes and their strftime equivalents
+to_char_codes = {'YYYY': '%Y', 'MM': '%m', 'DD': '%d', 'HH24': '%H', 'MI': '%M', 'SS': '%S'}
+
+def to_char(ts, fmt):
+    if ts is None:
+        return None
+    return parse_timestamp(ts).strftime(
+        re.sub('YYYY|HH24|MM|DD|MI|SS', lambda m: to_char_codes[m.group(0)], fmt)
+    )
+
+def concat_ws(sep, *args):
+    return sep.join(str(a) for a in args if a is not None)
+
+def connect(snapshot_file):
+    """Open a snapshot, with the functions needed to run translated postgres queries."""
+    if not os.path.isfile(snapshot_file):
+        raise RuntimeError("Database snapshot {f} does not exist.".format(f=snapshot_file))
+    con = sqlite3.connect(snapshot_file)
+    # return strings as str instead of unicode, as psycopg2 does
+    con.text_factory = str
+    con.create_function('add_years', 2, add_years)
+    con.create_function('to_char', 2, to_char)
+    con.create_function('concat_ws', -1, concat_ws)
+    return con
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print "usage: python db_snapshot.py <snapshot_file> <time_sample> [<time_sample> ...]"
+        sys.exit(1)
+    import write_pyomo_table
+    pg_con = write_pyomo_table.get_pool().getconn()
+    create_snapshot(pg_con, sys.argv[1], sys.argv[2:])
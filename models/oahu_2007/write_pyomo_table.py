@@ -1,6 +1,8 @@
-import time, sys
+import os, re, time, sys, threading, atexit, json, hashlib, shutil, itertools
+import Queue
 from textwrap import dedent
-import psycopg2
+import psycopg2, psycopg2.pool
+import db_snapshot
 
 # TODO: set this up to use ssl certificates or an SSH tunnel, because
 # otherwise postgres sends the password over the network as clear text.
@@ -17,38 +19,422 @@ import psycopg2
 # NOTE: this does not use the python csv writer because it doesn't support the quoting
 # or null behaviors described above.
 
-try:
-    pghost='switch.eng.hawaii.edu'
-    # note: the connection gets created when the module loads and never gets closed (until presumably python exits)
-    con = psycopg2.connect(database='switch', host=pghost, user='switch_user')
-    
-except psycopg2.OperationalError:
-    print dedent("""
-        ############################################################################################
-        Error while connecting to switch database on postgres server {server} as user 'switch_user'.
-        Please ensure that there is a line like "*:*:*:switch_user:<password>" in 
-        ~/.pgpass (which should be chmod 0600) or %APPDATA%\postgresql\pgpass.conf (Windows).    
-        See http://www.postgresql.org/docs/9.1/static/libpq-pgpass.html for more details.
-        ############################################################################################
-        """.format(server=pghost))
-    raise
+# NOTE: by default, tables are streamed straight to the file via COPY ... TO STDOUT 
+# (see copy_to_file()), which is much faster for large tables. The server does the same 
+# translations as the row-by-row writer, so the files are byte-for-byte the same either way. 
+# COPY is only used for tables whose columns it can format exactly like str() does (integers,
+# strings, booleans and numerics, see copy_types) and whose ORDER BY clause (if any) can be
+# moved to the outer query that does the formatting; other tables (e.g., ones with floating 
+# point columns) are written row by row. Set use_copy to False to write every table row by row.
+use_copy = True
+
+# NOTE: the first table written via COPY in each run is also written row by row, and an
+# error is raised if the two files differ. Set check_copy to False to skip this.
+check_copy = True
+
+# NOTE: the row-by-row writer reads the query results through a named (server-side) cursor,
+# which transfers itersize rows at a time, so memory use stays flat however large the
+# table is. (COPY also streams the data, so it never holds the whole table in memory.)
+itersize = 20000
+
+# postgres type codes for columns that are treated as strings or booleans
+# (char, name, text, bpchar, varchar and bool), and for the other columns that
+# COPY can write the same way as str() (int8, int2, int4, oid and numeric)
+string_types = set([18, 19, 25, 1042, 1043])
+bool_types = set([16])
+numeric_types = set([1700])
+copy_types = set([20, 21, 23, 26]) | string_types | bool_types | numeric_types
+
+# NOTE: the tables are independent, so up to max_connections of them are queried and written
+# at the same time, each on its own connection from a pool. write_table() returns as soon as 
+# the table has been queued; call finish() to wait until all the tables have been written
+# (this is also done automatically when python exits). Set max_connections to 1 to write 
+# each table before write_table() returns.
+max_connections = 4
+
+# NOTE: each directory that tables are written to gets a manifest (manifest.json), which
+# records a signature for each file: a hash of the query text with its argument values
+# and the change counters of the database tables it reads (from pg_stat_user_tables).
+# Files whose signature hasn't changed are not written again. If base_dir is set (e.g., to 
+# the main inputs directory while writing an alternative one), files that would be the 
+# same as the ones in base_dir are hard-linked from there instead of being queried.
+# Set incremental to False to write every table every time.
+incremental = True
+base_dir = None
+manifest_name = 'manifest.json'
+
+# NOTE: if the SWITCH_DB_SNAPSHOT environment variable is set, the queries are run on that
+# local snapshot of the database instead of the postgres server (see db_snapshot.py).
+snapshot_file = os.environ.get('SWITCH_DB_SNAPSHOT')
+
+pghost='switch.eng.hawaii.edu'
+pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """Return the pool of connections to the postgres server, connecting the first time it's needed."""
+    global pool
+    with _pool_lock:
+        if pool is None:
+            try:
+                # note: the pool opens one connection now and more as needed;
+                # they never get closed (until presumably python exits)
+                pool = psycopg2.pool.ThreadedConnectionPool(
+                    1, max_connections, database='switch', host=pghost, user='switch_user'
+                )
+            except psycopg2.OperationalError:
+                print dedent("""
+                    ############################################################################################
+                    Error while connecting to switch database on postgres server {server} as user 'switch_user'.
+                    Please ensure that there is a line like "*:*:*:switch_user:<password>" in 
+                    ~/.pgpass (which should be chmod 0600) or %APPDATA%\postgresql\pgpass.conf (Windows).    
+                    See http://www.postgresql.org/docs/9.1/static/libpq-pgpass.html for more details.
+                    Or set SWITCH_DB_SNAPSHOT to use a local snapshot instead (see db_snapshot.py).
+                    ############################################################################################
+                    """.format(server=pghost))
+                raise
+    return pool
+
+# tables waiting to be written, the threads writing them, and any errors that occurred
+_queue = Queue.Queue()
+_threads = []
+_errors = []
+_start_time = None
+_table_count = 0
 
 def write_table(output_file, query, arguments):
-    cur = con.cursor()
+    """Write the results of the query to output_file (in the background if max_connections > 1)."""
+    global _start_time, _table_count
+    if _start_time is None:
+        _start_time = time.time()
+    _table_count += 1
+    if max_connections <= 1:
+        _write_table(output_file, query, arguments)
+    else:
+        while len(_threads) < max_connections:
+            thread = threading.Thread(target=_run)
+            thread.daemon = True
+            thread.start()
+            _threads.append(thread)
+        # note: arguments are copied in case the caller changes them before the query runs
+        _queue.put((output_file, query, dict(arguments)))
+
+def _run():
+    while True:
+        (output_file, query, arguments) = _queue.get()
+        try:
+            _write_table(output_file, query, arguments)
+        except Exception as e:
+            print "Error while writing {file}: {e}".format(file=output_file, e=e)
+            _errors.append((output_file, sys.exc_info()))
+        finally:
+            _queue.task_done()
+
+def finish():
+    """Wait until all queued tables have been written, then report the total time
+    (raises the first error that occurred, if any)."""
+    global _start_time, _table_count
+    _queue.join()
+    if _start_time is not None:
+        print "Wrote {n} tables in {dur:.2f}s".format(n=_table_count, dur=time.time()-_start_time)
+        _start_time, _table_count = None, 0
+    if _errors:
+        (output_file, (t, e, tb)) = _errors[0]
+        del _errors[:]
+        raise t, e, tb
 
-    print "Writing {file} ...".format(file=output_file),
-    sys.stdout.flush()  # display the part line to the user
+atexit.register(finish)
+
+def _write_table(output_file, query, arguments):
+    if snapshot_file is not None:
+        con = db_snapshot.connect(snapshot_file)
+        try:
+            _write_table_from(con.cursor(), output_file, query, arguments)
+        finally:
+            con.close()
+    else:
+        pool = get_pool()
+        con = pool.getconn()
+        try:
+            _write_table_from(con.cursor(), output_file, query, arguments)
+        finally:
+            # end the (read-only) transaction before returning the connection to the pool
+            con.rollback()
+            pool.putconn(con)
 
+def _write_table_from(cur, output_file, query, arguments):
+    if not incremental:
+        _query_to_file(cur, output_file, query, arguments)
+        return
+    (directory, filename) = os.path.split(output_file)
+    signature = table_signature(cur, query, arguments)
+    if os.path.isfile(output_file) and read_manifest(directory).get(filename) == signature:
+        print "{file} is up to date".format(file=output_file)
+        return
+    base_file = None if base_dir is None else os.path.join(base_dir, filename)
+    if (
+        base_file is not None
+        and os.path.abspath(base_file) != os.path.abspath(output_file)
+        and os.path.isfile(base_file)
+        and read_manifest(base_dir).get(filename) == signature
+    ):
+        link_file(base_file, output_file)
+        print "Linked {file} from {base}".format(file=output_file, base=base_dir)
+    else:
+        _query_to_file(cur, output_file, query, arguments)
+    update_manifest(directory, filename, signature)
+
+def _query_to_file(cur, output_file, query, arguments):
     start=time.time()
-    cur.execute(dedent(query), arguments)
+    # note: the table is written to a temporary file and then moved into place, so an
+    # interrupted run never leaves a partly written table behind, and a file that is 
+    # hard-linked from another inputs directory is replaced, not changed
+    tmp_file = output_file + '.tmp'
+    if not (snapshot_file is None and use_copy and copy_to_file(cur, tmp_file, query, arguments)):
+        rows_to_file(cur, tmp_file, query, arguments)
+    replace_file(tmp_file, output_file)
+
+    # note: each table is reported in one line, because they may finish in any order
+    print "Wrote {file} (time taken: {dur:.2f}s)".format(file=output_file, dur=time.time()-start)
+
+def rows_to_file(cur, output_file, query, arguments):
+    """Write the results of the query to output_file in pyomo .tab format, one row at a time."""
+    if snapshot_file is not None:
+        # note: sqlite cursors already fetch rows as they are needed
+        cur.execute(*db_snapshot.translate_query(query, arguments))
+    else:
+        cur = cur.connection.cursor(name='write_table')
+        cur.itersize = itersize
+        cur.execute(dedent(query), arguments)
+    # note: named cursors only report the column names after the first rows are fetched
+    first_rows = cur.fetchmany(itersize)
 
     with open(output_file, 'w') as f:
         # write header row
         writerow(f, [d[0] for d in cur.description])
         # write the query results (cur is used as an iterator here to get all the rows one by one)
-        writerows(f, cur)
+        writerows(f, itertools.chain(first_rows, cur))
+    cur.close()
+
+def replace_file(src, dest):
+    if os.name == 'nt' and os.path.exists(dest):
+        os.remove(dest)     # os.rename() can't replace files on Windows
+    os.rename(src, dest)
+
+def link_file(src, dest):
+    """Make dest a hard link to src (or a copy, if hard links aren't available)."""
+    if os.path.exists(dest):
+        os.remove(dest)
+    if hasattr(os, 'link'):
+        os.link(src, dest)
+    else:
+        shutil.copy2(src, dest)
+
+def table_signature(cur, query, arguments):
+    """Return a hash that identifies the contents of the table a query would produce."""
+    if snapshot_file is not None:
+        # identify the snapshot by its location and modification time
+        st = os.stat(snapshot_file)
+        return hashlib.sha1(repr((
+            db_snapshot.translate_query(query, arguments), 
+            os.path.abspath(snapshot_file), st.st_mtime, st.st_size
+        ))).hexdigest()
+    query = cur.mogrify(dedent(query), arguments).strip().rstrip(';')
+    # find the tables the query reads (views are expanded to their underlying tables)
+    cur.execute("EXPLAIN (FORMAT JSON) " + query)
+    plan = cur.fetchone()[0]
+    if isinstance(plan, basestring):
+        plan = json.loads(plan)
+    relations = sorted(set(plan_relations(plan)))
+    # note: the change counters are cumulative, so they change whenever rows are 
+    # inserted, updated or deleted (or the statistics are reset)
+    if len(relations) > 0:
+        cur.execute("""
+            SELECT relname, n_tup_ins, n_tup_upd, n_tup_del FROM pg_stat_user_tables
+            WHERE relname IN %s ORDER BY 1, 2, 3, 4;
+        """, (tuple(relations),))
+        counters = cur.fetchall()
+    else:
+        counters = []
+    return hashlib.sha1(repr((query, counters))).hexdigest()
+
+def plan_relations(node):
+    """Return the names of all the tables used in a query plan (from EXPLAIN (FORMAT JSON))."""
+    if isinstance(node, dict):
+        if "Relation Name" in node:
+            yield node["Relation Name"]
+        for v in node.itervalues():
+            for r in plan_relations(v):
+                yield r
+    elif isinstance(node, list):
+        for v in node:
+            for r in plan_relations(v):
+                yield r
+
+_manifest_lock = threading.Lock()
+
+def read_manifest(directory):
+    """Return the signatures of the files in a directory (an empty dict if there's no manifest)."""
+    try:
+        with open(os.path.join(directory, manifest_name)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
 
-    print "time taken: {dur:.2f}s".format(dur=time.time()-start)
+def update_manifest(directory, filename, signature):
+    """Record the signature for one file in the manifest for its directory."""
+    with _manifest_lock:
+        manifest = read_manifest(directory)
+        manifest[filename] = signature
+        manifest_file = os.path.join(directory, manifest_name)
+        with open(manifest_file + '.tmp', 'w') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        replace_file(manifest_file + '.tmp', manifest_file)
+
+_copy_checked = False
+_copy_check_lock = threading.Lock()
+
+def copy_to_file(cur, output_file, query, arguments):
+    """Write the results of the query to output_file in pyomo .tab format, using COPY ... TO STDOUT
+    with the quoting and null translations done by the server. Returns False if the table can't
+    be written this way exactly as the row-by-row writer would (the caller should use that instead)."""
+    global _copy_checked
+    sql = cur.mogrify(dedent(query), arguments).strip().rstrip(';')
+    # get the column names and types without running the full query
+    cur.execute("SELECT * FROM ({q}) AS q LIMIT 0;".format(q=sql))
+    columns = [(d[0], d[1]) for d in cur.description]
+    if any(type_code not in copy_types for (name, type_code) in columns):
+        return False
+    # note: postgres doesn't promise to keep the order of the rows from a subquery, 
+    # so the ORDER BY clause is applied to the outer query instead
+    order = copy_order(sql, [name for (name, type_code) in columns])
+    if order is None:
+        return False
+    copy_query = "SELECT {cols} FROM ({q}) AS q{order}".format(
+        cols=", ".join(copy_expression(name, type_code) for (name, type_code) in columns),
+        q=sql,
+        order=" ORDER BY " + order if order else ""
+    )
+    with open(output_file, 'w') as f:
+        writerow(f, [name for (name, type_code) in columns])
+        # note: csv format writes backslashes as-is (text format would escape them).
+        # It quotes values that contain the delimiter, a line break, the quote character 
+        # or that match the null string; chr(1) is used as the quote character, so
+        # these values can be found afterwards.
+        cur.copy_expert(
+            "COPY ({q}) TO STDOUT WITH (FORMAT csv, DELIMITER E'\\t', NULL '.', QUOTE E'\\x01');"
+            .format(q=copy_query), f
+        )
+    # fall back to the row-by-row writer if any values were quoted
+    with open(output_file, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), ''):
+            if '\x01' in chunk:
+                return False
+
+    with _copy_check_lock:
+        if check_copy and not _copy_checked:
+            _copy_checked = True
+            check_file = output_file + '.check'
+            rows_to_file(cur, check_file, query, arguments)
+            if not files_equal(output_file, check_file):
+                raise RuntimeError(
+                    "COPY and the row-by-row writer produced different versions of {file} "
+                    "(see {check}); set use_copy to False to avoid this."
+                    .format(file=output_file, check=check_file)
+                )
+            os.remove(check_file)
+    return True
+
+def files_equal(file1, file2):
+    """Return True if two files have the same contents."""
+    with open(file1, 'rb') as f1, open(file2, 'rb') as f2:
+        while True:
+            (b1, b2) = (f1.read(1 << 20), f2.read(1 << 20))
+            if b1 != b2:
+                return False
+            if b1 == '':
+                return True
+
+def copy_order(query, names):
+    """Return the ORDER BY clause at the end of the query, rewritten to refer to the query's
+    output columns (q."name") so it can be used in a query that selects from this one. Returns ''
+    if there is no ORDER BY clause, or None if it uses anything but column names and positions
+    (or is followed by LIMIT, OFFSET, etc.)."""
+    # find the last ORDER BY that isn't inside parentheses or quotes
+    (depth, quote, start) = (0, None, None)
+    for (i, char) in enumerate(query):
+        if quote is not None:
+            if char == quote:
+                quote = None
+        elif char in '\'"':
+            quote = char
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif depth == 0:
+            match = re.match(r'\border\s+by\b', query[i:i+20], re.IGNORECASE)
+            if match and (i == 0 or not (query[i-1].isalnum() or query[i-1] == '_')):
+                start = i + match.end()
+    if start is None:
+        return ''
+    keys = []
+    for item in query[start:].split(','):
+        match = re.match(
+            r'^\s*(\d+|\w+|"[^"]+")((\s+(asc|desc))?(\s+nulls\s+(first|last))?)\s*$', 
+            item, re.IGNORECASE
+        )
+        if match is None:
+            return None
+        (key, direction) = match.group(1, 2)
+        if key.isdigit():
+            if not 1 <= int(key) <= len(names):
+                return None
+            name = names[int(key)-1]
+        elif key.startswith('"'):
+            name = key[1:-1]
+        else:
+            # postgres converts unquoted names to lower case
+            name = key.lower()
+        if names.count(name) != 1:
+            return None
+        keys.append('q."{n}"{d}'.format(n=name.replace('"', '""'), d=direction))
+    return ", ".join(keys)
+
+def copy_expression(name, type_code):
+    """Return an SQL expression that formats one column the same way stringify() would."""
+    col = 'q."{n}"'.format(n=name.replace('"', '""'))
+    if type_code in string_types:
+        # double any double quotes, then quote values that contain spaces, tabs or quotes
+        return dedent("""
+            CASE WHEN {c} ~ ('[ ' || chr(9) || '"'']') 
+                THEN '"' || replace({c}, '"', '""') || '"' 
+                ELSE {c}::text 
+            END
+        """).format(c=col)
+    elif type_code in bool_types:
+        return "CASE WHEN {c} THEN 'True' WHEN NOT {c} THEN 'False' END".format(c=col)
+    elif type_code in numeric_types:
+        # numerics are read as Decimals, and str(Decimal) switches to scientific notation 
+        # when there are 6 or more zeros after the decimal point (e.g., 1.0E-7 or 0E-7)
+        return dedent(r"""
+            CASE 
+                WHEN {c} = 0 AND {c}::text LIKE '0.0000000%' 
+                    THEN '0E-' || (length({c}::text) - 2)
+                WHEN {c} <> 0 AND abs({c}) < 0.000001 
+                    THEN CASE WHEN {c} < 0 THEN '-' ELSE '' END
+                        || left(regexp_replace(abs({c})::text, '^0\.0*', ''), 1)
+                        || CASE WHEN length(regexp_replace(abs({c})::text, '^0\.0*', '')) > 1 
+                            THEN '.' || substr(regexp_replace(abs({c})::text, '^0\.0*', ''), 2) 
+                            ELSE '' 
+                        END
+                        || 'E-' || (length(abs({c})::text) - 1 
+                            - length(regexp_replace(abs({c})::text, '^0\.0*', '')))
+                ELSE {c}::text
+            END
+        """).format(c=col)
+    else:
+        return col
 
 def stringify(val):
     if val is None:
@@ -2,14 +2,21 @@
 # cancel out the basic system load and replace it with a convex combination of bids
 """
 
-import os
+import os, multiprocessing
 from pprint import pprint
+from collections import defaultdict
+import numpy as np
 from pyomo.environ import *
 import switch_mod.utilities as utilities
 import doubleCES2 as ces
 import constant_elasticity as ce
 import util
 
+# add each new bid to the model as a new set of columns in the existing demand response rows, 
+# instead of reconstructing all the components that depend on m.DR_BID_LIST (see add_bid_columns()).
+# This must be set before the model is defined.
+column_generation = False
+
 def define_components(m):
     """
 
@@ -53,7 +60,13 @@ def define_components(m):
     m.dr_bid_benefit = Param(m.DR_BID_LIST, m.LOAD_ZONES, m.TIMESERIES, mutable=True)
 
     # weights to assign to the bids for each timeseries when constructing an optimal demand profile
-    m.DRBidWeight = Var(m.DR_BID_LIST, m.LOAD_ZONES, m.TIMESERIES, within=NonNegativeReals)
+    if column_generation:
+        # the weights for each bid are added to the model as a separate Var by add_bid_columns();
+        # this dictionary holds all of them, indexed by (bid, lz, ts), so they can be used the
+        # same way as an indexed Var.
+        m.DRBidWeight = dict()
+    else:
+        m.DRBidWeight = Var(m.DR_BID_LIST, m.LOAD_ZONES, m.TIMESERIES, within=NonNegativeReals)
     
     # def DR_Convex_Bid_Weight_rule(m, lz, ts):
     #     if len(m.DR_BID_LIST) == 0:
@@ -68,11 +81,35 @@ def define_components(m):
         Constraint.Skip if len(m.DR_BID_LIST) == 0 else (sum(m.DRBidWeight[b, lz, ts] for b in m.DR_BID_LIST) == 1)
     )
     
+    if column_generation:
+        # total demand and private benefit from the bids, defined by rows that get one new
+        # term for each bid. Energy_Balance and the objective function only refer to these
+        # variables, so they don't change when bids are added.
+        m.DRFlexibleLoad = Var(m.LOAD_ZONES, m.TIMEPOINTS, within=NonNegativeReals)
+        m.DR_Flexible_Load_Definition = Constraint(m.LOAD_ZONES, m.TIMEPOINTS, rule=lambda m, lz, tp: (
+            0.0,
+            m.DRFlexibleLoad[lz, tp] 
+            - sum(m.DRBidWeight[b, lz, m.tp_ts[tp]] * m.dr_bid[b, lz, tp] for b in m.DR_BID_LIST),
+            0.0
+        ))
+        m.DRPrivateBenefit = Var(m.LOAD_ZONES, m.TIMESERIES)
+        m.DR_Private_Benefit_Definition = Constraint(m.LOAD_ZONES, m.TIMESERIES, rule=lambda m, lz, ts: (
+            0.0,
+            m.DRPrivateBenefit[lz, ts] 
+            - sum(m.DRBidWeight[b, lz, ts] * m.dr_bid_benefit[b, lz, ts] for b in m.DR_BID_LIST),
+            0.0
+        ))
+
     # Optimal level of demand, calculated from available bids (negative, indicating consumption)
-    m.FlexibleDemand = Expression(m.LOAD_ZONES, m.TIMEPOINTS, 
-        rule=lambda m, lz, tp:
-            - sum(m.DRBidWeight[b, lz, m.tp_ts[tp]] * m.dr_bid[b, lz, tp] for b in m.DR_BID_LIST)
-    )
+    if column_generation:
+        m.FlexibleDemand = Expression(m.LOAD_ZONES, m.TIMEPOINTS, 
+            rule=lambda m, lz, tp: - m.DRFlexibleLoad[lz, tp]
+        )
+    else:
+        m.FlexibleDemand = Expression(m.LOAD_ZONES, m.TIMEPOINTS, 
+            rule=lambda m, lz, tp:
+                - sum(m.DRBidWeight[b, lz, m.tp_ts[tp]] * m.dr_bid[b, lz, tp] for b in m.DR_BID_LIST)
+        )
 
     # # FlexibleDemand reported as an adjustment (negative equals more demand)
     # # We have to do it this way because there's no way to remove the lz_demand_mw from the model
@@ -85,12 +122,19 @@ def define_components(m):
     # (i.e., willingness to pay for the current electricity supply)
     # reported as negative cost, i.e., positive benefit
     # also divide by 24 to convert from a daily cost to a cost per timepoint.
-    m.DR_Welfare_Cost = Expression(m.TIMEPOINTS, rule=lambda m, tp:
-        (-1.0) 
-        * sum(m.DRBidWeight[b, lz, m.tp_ts[tp]] * m.dr_bid_benefit[b, lz, m.tp_ts[tp]] 
-            for b in m.DR_BID_LIST for lz in m.LOAD_ZONES) 
-        * m.tp_duration_hrs[tp] / 24.0
-    )
+    if column_generation:
+        m.DR_Welfare_Cost = Expression(m.TIMEPOINTS, rule=lambda m, tp:
+            (-1.0) 
+            * sum(m.DRPrivateBenefit[lz, m.tp_ts[tp]] for lz in m.LOAD_ZONES) 
+            * m.tp_duration_hrs[tp] / 24.0
+        )
+    else:
+        m.DR_Welfare_Cost = Expression(m.TIMEPOINTS, rule=lambda m, tp:
+            (-1.0) 
+            * sum(m.DRBidWeight[b, lz, m.tp_ts[tp]] * m.dr_bid_benefit[b, lz, m.tp_ts[tp]] 
+                for b in m.DR_BID_LIST for lz in m.LOAD_ZONES) 
+            * m.tp_duration_hrs[tp] / 24.0
+        )
 
     # add the private benefit to the model's objective function
     m.cost_components_tp.append('DR_Welfare_Cost')
@@ -104,6 +148,12 @@ Theta = dict( theta = -0.075,
               gamma = 0.01
 )
 N = 1000    # number of steps to use in calculating consumer surplus
+
+# number of worker processes used to calculate the bids for each iteration
+# (1 = calculate them all in this process)
+bid_workers = min(8, multiprocessing.cpu_count())
+# pool of bid workers (created the first time it's needed, then reused for every iteration)
+bid_pool = None
 def update_demand(m, tag):
     """
     This should be called after solving the model, in order to calculate new bids
@@ -160,8 +210,8 @@ def update_demand(m, tag):
         )
 
 
-    # get new demand bids at the current marginal costs
-    bids = []
+    # get the current marginal costs for each load zone and timeseries
+    all_prices = []
     for i, (lz, ts, baseLoad, basePrice) in enumerate(baseData):
         # TODO: add in something for the fixed costs
         prices = [m.dual[m.Energy_Balance[lz, tp]]/m.bring_timepoint_costs_to_base_year[tp] for tp in m.TS_TPS[ts]]
@@ -170,15 +220,18 @@ def update_demand(m, tag):
         # if i < 2:
         #     print "prices (day {i}): {p}".format(i=i, p=prices)
         #     print "weights: {w}".format(w=[m.bring_timepoint_costs_to_base_year[tp] for tp in m.TS_TPS[ts]])
-        if '_ce_' in tag:
-            (demand, wtp) = ce.bid(prices, baseLoad, basePrice)
-        else:
-            demand = ces.double_ces(prices, Theta, baseLoad, basePrice)
-            wtp = ces.wtp(prices, Theta, baseLoad, basePrice)
-        bids.append((lz, ts, prices, demand, wtp))
+        all_prices.append(prices)
 
-        # if i < 2:
-        #     import pdb; pdb.set_trace()
+    # get new demand bids at these prices
+    bid_values = get_bids(
+        '_ce_' in tag,
+        [(prices, baseLoad, basePrice) for (prices, (lz, ts, baseLoad, basePrice)) in zip(all_prices, baseData)]
+    )
+    bids = [
+        (lz, ts, prices, demand, wtp) 
+            for ((lz, ts, baseLoad, basePrice), prices, (demand, wtp)) 
+                in zip(baseData, all_prices, bid_values)
+    ]
 
     print "adding bids to model; first day="
     pprint(bids[0])
@@ -204,6 +257,107 @@ def update_demand(m, tag):
         m.LZ_Energy_Balance_components.append('FlexibleDemand')
         m.Energy_Balance.reconstruct()
 
+def get_bids(constant_elasticity, requests):
+    """Return (demand, wtp) for each of a list of (prices, baseLoad, basePrice) tuples,
+    in the same order. The bids are independent, so they are split into contiguous
+    chunks and calculated in parallel by the bid_workers processes."""
+    global bid_pool
+    if bid_workers <= 1 or len(requests) < 2:
+        return calculate_bids((constant_elasticity, requests))
+    # make sure the workers share the random draws used by ces.wtp_batch(), so the 
+    # results don't depend on which worker calculates each bid
+    max_len = max(len(prices) for (prices, baseLoad, basePrice) in requests)
+    if bid_pool is not None and ces.draws.shape[1] < max_len:
+        bid_pool.terminate()
+        bid_pool = None
+    if bid_pool is None:
+        ces.draws_for(max_len)
+        # note: the workers are forked from this process, so they inherit the draws
+        bid_pool = multiprocessing.Pool(bid_workers)
+    n_chunks = min(bid_workers, len(requests))
+    chunks = [requests[i*len(requests)//n_chunks:(i+1)*len(requests)//n_chunks] for i in range(n_chunks)]
+    results = bid_pool.map(calculate_bids, [(constant_elasticity, c) for c in chunks])
+    return [bid for chunk in results for bid in chunk]
+
+def calculate_bids((constant_elasticity, requests)):
+    """Return (demand, wtp) for each of a list of (prices, baseLoad, basePrice) tuples.
+    For the double CES demand system, all the requests with the same number of timepoints
+    are evaluated in one call to ces.bids() (normally this is all of them)."""
+    if constant_elasticity:
+        return [ce.bid(prices, baseLoad, basePrice) for (prices, baseLoad, basePrice) in requests]
+    bid_values = [None] * len(requests)
+    rows_by_length = defaultdict(list)
+    for i, (prices, baseLoad, basePrice) in enumerate(requests):
+        rows_by_length[len(prices)].append(i)
+    for rows in rows_by_length.values():
+        (demand, wtp) = ces.bids(
+            np.array([requests[i][0] for i in rows]), 
+            Theta, 
+            np.array([requests[i][1] for i in rows]), 
+            np.array([requests[i][2] for i in rows])
+        )
+        for (j, i) in enumerate(rows):
+            bid_values[i] = (demand[j], wtp[j])
+    return bid_values
+
+# number of solutions in a row for which each bid has had zero weight everywhere
+zero_weight_count = dict()
+
+def prune_bids(m, max_zero_iterations, tag, tolerance=1e-6):
+    """
+    Remove bids from m.DR_BID_LIST if they have had zero weight in every load zone and
+    timeseries in the last max_zero_iterations solutions. This should be called after
+    solving the model and before update_demand(), which adds the next bid and reconstructs
+    the components that depend on m.DR_BID_LIST. The newest bid is never removed.
+    The final weights of the removed bids are added to the bid_weights file (with the same
+    iteration number that update_demand() will use for the remaining bids), and their 
+    entries in m.dr_bid and m.dr_bid_benefit are deleted.
+    Returns a list of the bids that were removed.
+    """
+    if len(m.DR_BID_LIST) == 0:
+        return []
+    newest = max(m.DR_BID_LIST)
+    pruned = []
+    for b in list(m.DR_BID_LIST):
+        if all(
+            (m.DRBidWeight[b, lz, ts].value or 0.0) <= tolerance 
+                for lz in m.LOAD_ZONES for ts in m.TIMESERIES
+        ):
+            zero_weight_count[b] = zero_weight_count.get(b, 0) + 1
+        else:
+            zero_weight_count[b] = 0
+        if zero_weight_count[b] >= max_zero_iterations and b != newest:
+            del zero_weight_count[b]
+            pruned.append(b)
+    if len(pruned) == 0:
+        return pruned
+
+    # store the last weights for the pruned bids (before removing them), since 
+    # update_demand() will only record the weights for the bids that remain
+    n_bids = len(m.DR_BID_LIST) - len(pruned)
+    util.append_table(m, m.LOAD_ZONES, m.TIMESERIES, pruned, 
+        output_file=os.path.join("outputs", "bid_weights_{t}.txt".format(t=tag)), 
+        values=lambda m, lz, ts, b: (n_bids, lz, ts, b, m.DRBidWeight[b, lz, ts])
+    )
+
+    for b in pruned:
+        m.DR_BID_LIST.remove(b)
+        if column_generation:
+            # the bid's columns stay in the rows, so take them out of the problem by
+            # fixing the weights at zero
+            for lz in m.LOAD_ZONES:
+                for ts in m.TIMESERIES:
+                    m.DRBidWeight[b, lz, ts].fix(0.0)
+        # drop the bid data, so it doesn't accumulate over many iterations
+        # note: in column generation mode, the rows still refer to these values directly,
+        # so they aren't affected by this
+        for lz in m.LOAD_ZONES:
+            for ts in m.TIMESERIES:
+                m.dr_bid_benefit._data.pop((b, lz, ts), None)
+            for tp in m.TIMEPOINTS:
+                m.dr_bid._data.pop((b, lz, tp), None)
+    return pruned
+
 def sum_product(vector1, vector2):
     return sum(v1*v2 for (v1, v2) in zip(vector1, vector2))
 
@@ -219,6 +373,8 @@ def add_bids(m, bids, tag):
     # create a bid ID and add it to the list of bids
     if len(m.DR_BID_LIST) == 0:
         b = 1
+        # forget the zero-weight history from any earlier run (see prune_bids())
+        zero_weight_count.clear()
     else:
         b = max(m.DR_BID_LIST) + 1
 
@@ -291,6 +447,10 @@ def add_bids(m, bids, tag):
         )
     )
 
+    if column_generation:
+        add_bid_columns(m, b)
+        return
+
     # reconstruct the components that depend on m.DR_BID_LIST, m.dr_bid_benefit and m.dr_bid
     m.DRBidWeight.reconstruct()
     m.DR_Convex_Bid_Weight.reconstruct()
@@ -306,3 +466,36 @@ def add_bids(m, bids, tag):
     m.SystemCostPerPeriod.reconstruct()
     m.Minimize_System_Cost.reconstruct()    # may not be needed, since it seems to store the rule
                                             # rather than the result of the rule
+
+def add_bid_columns(m, b):
+    """
+    Add weight variables for bid b to the model (column generation mode) and append
+    them to the existing convexity, flexible load and private benefit rows. This only 
+    touches the terms for the new bid, so the time taken doesn't depend on the number 
+    of bids already in the model, and Energy_Balance and the objective function are 
+    left alone.
+    """
+    weight = Var(m.LOAD_ZONES, m.TIMESERIES, within=NonNegativeReals)
+    m.add_component('DRBidWeight_{b}'.format(b=b), weight)
+    for lz in m.LOAD_ZONES:
+        for ts in m.TIMESERIES:
+            m.DRBidWeight[b, lz, ts] = weight[lz, ts]
+
+    if len(m.DR_Convex_Bid_Weight) == 0:
+        # the convexity rows are skipped until there is at least one bid
+        m.DR_Convex_Bid_Weight.reconstruct()
+    else:
+        for lz in m.LOAD_ZONES:
+            for ts in m.TIMESERIES:
+                append_to_row(m.DR_Convex_Bid_Weight[lz, ts], weight[lz, ts])
+    for lz in m.LOAD_ZONES:
+        for ts in m.TIMESERIES:
+            append_to_row(m.DR_Private_Benefit_Definition[lz, ts], 
+                - weight[lz, ts] * m.dr_bid_benefit[b, lz, ts])
+        for tp in m.TIMEPOINTS:
+            append_to_row(m.DR_Flexible_Load_Definition[lz, tp], 
+                - weight[lz, m.tp_ts[tp]] * m.dr_bid[b, lz, tp])
+
+def append_to_row(c, term):
+    """Add a term to the body of constraint c, keeping the same bounds."""
+    c.set_value((c.lower, c.body + term, c.upper))
@@ -20,6 +20,10 @@
 #           calibrate other parameters in the demand system.
 #
 #   3.   cs(N, p, Theta, baseLoad, basePrice): approximates the consumers' surplus using N partitions
+#
+#   4.   double_ces_batch(P, Theta, baseLoads, basePrices) and bids(P, Theta, baseLoads, basePrices):
+#           the same demand system (and willingness to pay) evaluated for many days at once;
+#           each row of P and baseLoads holds the prices and base loads for one day.
 ######################################################################
 ######################################################################
 
@@ -88,6 +92,70 @@ def wtp( p, Theta, baseLoad, basePrice, maxPrice=1000):
  paid = p*double_ces(p, Theta, baseLoad, basePrice)
  return( np.sum(cs) + np.sum(paid) )
 
+
+####################################################
+#   Batch versions: one row per day (or load zone and day)
+####################################################
+def ces_batch(p, alpha, sigma, M=1.0):
+ # standard CES demands for each row of the price matrix p
+ # (alpha is a vector of share coefficients, the same for all rows)
+ fact = M / np.sum( (alpha**sigma) * p**(1-sigma), axis=1, keepdims=True )
+ return( fact*( alpha/p )**sigma )
+
+def double_ces_batch(P, Theta, baseLoads, basePrices):
+ # P and baseLoads are (days x hours) matrices; basePrices is a scalar or a vector (one per day)
+ # returns a (days x hours) matrix of demands, matching double_ces() for each row
+ theta   = Theta["theta"]
+ alpha   = Theta["alpha"]
+ sigma   = Theta["sigma"]
+ gamma   = Theta["gamma"]
+
+ P        = np.asarray(P, dtype=float)
+ baseLoads = np.asarray(baseLoads, dtype=float)
+ basePrices = np.asarray(basePrices, dtype=float).reshape(-1, 1)
+ pstar   = P/P[:, :1]        #  relative prices for each day
+
+ L = P.shape[1]
+ shares = np.repeat(1.0/L, L)
+ n   = ( alpha*ces_batch(pstar, shares, sigma)  +  (1-alpha)*ces_batch(pstar, shares, gamma) )
+ s   = n / np.sum(n, axis=1, keepdims=True)
+ ds  = L*(s - 1.0/L)
+ x1  = (1.0+ds)*baseLoads     # reallocated totals, without aggregate response
+ Pagg = np.sum(s*P, axis=1, keepdims=True)     # aggregate price for each day
+ A   = np.sum(baseLoads, axis=1, keepdims=True) / ( basePrices**theta )
+ X   = A*Pagg**theta          # aggregate quantity for each day
+ return( x1 * X/np.sum(x1, axis=1, keepdims=True) )
+
+def draws_for(L):
+ # the shared random draws, extended with more columns if there are more than 24 hours per day
+ global draws
+ if draws.shape[1] < L:
+   draws = np.hstack([draws, np.random.uniform(size=(N, L-draws.shape[1]))])
+ return draws[:, :L]
+
+def wtp_batch(P, Theta, baseLoads, basePrices, maxPrice=1000):
+ # willingness to pay for each row of P, matching wtp() for each row
+ # note: all the draws for one day are evaluated in a single call to double_ces_batch(),
+ # one day at a time to limit memory use
+ P        = np.asarray(P, dtype=float)
+ baseLoads = np.asarray(baseLoads, dtype=float)
+ basePrices = np.broadcast_to(np.asarray(basePrices, dtype=float), (P.shape[0],))
+ d = draws_for(P.shape[1])
+ result = np.zeros(P.shape[0])
+ for i in range(P.shape[0]):
+   p = P[i]
+   pmat = p + d*(maxPrice-p)
+   slices = double_ces_batch(pmat, Theta, np.tile(baseLoads[i], (N, 1)), basePrices[i])
+   cs = np.mean(slices, 0)*(maxPrice-p)
+   result[i] = np.sum(cs)
+ paid = P*double_ces_batch(P, Theta, baseLoads, basePrices)
+ return( result + np.sum(paid, axis=1) )
+
+def bids(P, Theta, baseLoads, basePrices, maxPrice=1000):
+ # demand (days x hours) and willingness to pay (one per day) for a matrix of prices
+ return( double_ces_batch(P, Theta, baseLoads, basePrices), 
+         wtp_batch(P, Theta, baseLoads, basePrices, maxPrice) )
+
 def example():
     # example
     p1 = np.repeat(30, 24)
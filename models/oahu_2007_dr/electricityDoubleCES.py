@@ -22,6 +22,9 @@ import numpy as np
 #           calibrate other parameters in the demand system.
 #
 #   3.   cs(N, p, Theta, baseLoad, basePrice): approximates the consumers' surplus using N partitions
+#
+#   4.   double_ces_matrix(P, Theta, baseLoad, basePrice): double_ces() for each row of the price
+#           matrix P at once (used to evaluate all the price slices of an integral in one step).
 ######################################################################
 ######################################################################
 
@@ -78,12 +81,44 @@ def double_ces(p, Theta, baseLoad, basePrice):
     return demand
 
 
+def double_ces_matrix(P, Theta, baseLoad, basePrice):
+    # same as double_ces(), but P is a matrix with one price vector in each row,
+    # and the result has the demand for each price vector in the matching row
+    theta   = Theta["theta"]
+    alpha   = Theta["alpha"]
+    sigma   = Theta["sigma"]
+    gamma   = Theta["gamma"]
+
+    P = np.asarray(P, dtype=float)
+    baseLoad = np.asarray(baseLoad, dtype=float)
+    basePrice = np.asarray(basePrice, dtype=float)
+
+    # relative prices (rows with a mean price of $0 are used as-is, as in double_ces())
+    p_mean = np.mean(P, axis=1, keepdims=True)
+    pstar = P / np.where(p_mean == 0, 1.0, p_mean)
+
+    L = P.shape[1]
+    shares = 1.0/L
+    # standard CES demands with equal shares and income of 1 (see ces())
+    ces1 = (shares/pstar)**sigma / np.sum((shares**sigma) * pstar**(1-sigma), axis=1, keepdims=True)
+    ces2 = (shares/pstar)**gamma / np.sum((shares**gamma) * pstar**(1-gamma), axis=1, keepdims=True)
+    n   = alpha*ces1 + (1-alpha)*ces2
+    s   = n / np.sum(n, axis=1, keepdims=True)
+    ds  = L*(s - 1.0/L)
+    x1  = (1+ds)*baseLoad                           # reallocated totals, without aggregate response
+    agg_P = np.sum(s*P, axis=1, keepdims=True)      # aggregate price for each row
+    A   = np.sum(baseLoad) / ( basePrice**theta )   # calibrate A to baseLoad and basePrice
+    X   = A*agg_P**theta                            # aggregate quantity for each row
+
+    return x1 * X/np.sum(x1, axis=1, keepdims=True)
+
+
 # Find consumers' surplus
 def cs(N, p, Theta, baseLoad, basePrice):
     p = np.array(p)   # enable element-wise math
-    slices = np.zeros((N, 24))
-    for i in range(N):  # note: python arrays and ranges start at 0; R starts at 1, so we add 1 in the line below
-        slices[i,:] = double_ces(p*N/(i+1), Theta, baseLoad, basePrice)
+    # note: python arrays and ranges start at 0; R starts at 1, so we add 1 in the line below
+    # (all N slices are evaluated at once, for any number of timepoints)
+    slices = double_ces_matrix(np.outer(float(N)/np.arange(1, N+1), p), Theta, baseLoad, basePrice)
     # note: python uses 0 to count down, 1 to count across; R uses 2 and 1 respectively.
     x = np.mean(slices, 0) * p  # MF added p to convert quantity to value
     return( sum(x) )
@@ -114,41 +149,47 @@ def cs_up1(N, p, Theta, baseLoad, basePrice):
     x2 = p * double_ces(p*(i+0.5)/N, Theta, baseLoad, basePrice)
     return( sum(x1) )
 
-def willingness_to_pay(p, Theta, baseLoad, basePrice):
+# smallest step from p toward p_max used when integrating willingness to pay
+# (matches the smallest step in the original 500-step ladder)
+wtp_min_step = 1.05**(-499)
+
+def willingness_to_pay(p, Theta, baseLoad, basePrice, rtol=1e-6, max_steps=100000):
     # calculate willingness to pay for the electricity bundle that would be bought at price p
     # this is equal to (consumer surplus at price p) + p * (quantity bought at price p)
 
     # convert to numpy array to allow easier calculations
-    p = np.array(p)
+    p = np.array(p, dtype=float)
 
     # highest possible price for power, used as the upper limit for integration of surplus
     p_max = np.repeat(basePrice * 10000, len(p))
 
-    # we want small price steps near p, and large steps near p_max (to get there reasonably quickly).
-    # so we create a geometric series from a small number up to 1, and use it to mix p and p_max
-    N = 500
-    step = 0.05
-    steps = np.array([0.0] + [(1.0+step)**(i) / ((1.0+step)**(N-1)) for i in range(N)])
-
-    # prices to use for integration
-    prices = np.array([(1.0-s)*p + s*p_max for s in steps])
-
-    slices = np.zeros((len(steps), len(p)))
-
-    for i in range(len(steps)):
-        slices[i,:] = double_ces(prices[i], Theta, baseLoad, basePrice)
+    # also include the amount paid for the quantity consumed at price p
+    direct = np.sum(p * double_ces(p, Theta, baseLoad, basePrice))
 
+    # we want small price steps near p, and large steps near p_max (to get there reasonably quickly).
+    # so we create a geometric series from a small number up to 1, and use it to mix p and p_max.
+    # The number of steps is doubled until the total changes by less than rtol.
+    n_steps = 64
+    surplus = None
+    while True:
+        steps = np.concatenate([[0.0], np.logspace(np.log10(wtp_min_step), 0.0, n_steps)])
+        new_surplus = integrate_surplus(steps, p, p_max, Theta, baseLoad, basePrice)
+        if surplus is not None and abs(new_surplus - surplus) <= rtol * abs(new_surplus + direct):
+            break
+        if n_steps >= max_steps:
+            break
+        (surplus, n_steps) = (new_surplus, n_steps * 2)
+
+    # print "price={p}, surplus={s}, direct={d}, steps={n}".format(p=np.mean(p), s=new_surplus, d=direct, n=n_steps)
+
+    return( new_surplus + direct )
+
+def integrate_surplus(steps, p, p_max, Theta, baseLoad, basePrice):
+    # prices to use for integration (one row per step)
+    prices = np.outer(1.0-steps, p) + np.outer(steps, p_max)
+    slices = double_ces_matrix(prices, Theta, baseLoad, basePrice)
     # use a trapezoidal approximation to calculate total price * quantity within each slice
-    surplus = np.zeros(len(p))
-    for i in range(len(steps)-1):
-        surplus += (prices[i+1]-prices[i]) * (slices[i]+slices[i+1]) / 2.0
-    
-    # also include the amount paid for the quantity consumed at price p
-    direct = p * double_ces(p*(i+0.5)/N, Theta, baseLoad, basePrice)
-    
-    # print "price={p}, surplus={s}, direct={d}".format(p=np.mean(p), s=np.sum(surplus), d=np.sum(direct))
-    
-    return( sum(surplus+direct) )
+    return np.sum(np.diff(prices, axis=0) * (slices[1:] + slices[:-1]) / 2.0)
 
 def example():
     p1 = np.repeat(30, 24)
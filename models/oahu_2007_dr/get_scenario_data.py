@@ -2,7 +2,7 @@
 
 # based on "Switch-Hawaii/ampl/working oahu version/get_scenario_data.py"
 
-from write_pyomo_table import write_table
+from write_pyomo_table import write_table, finish
 
 # NOTE: ANSI SQL specifies single quotes for literal strings, and postgres conforms
 # to this, so all the queries below should use single quotes around strings.
@@ -507,3 +507,6 @@ write_table('proj_commit_bounds_timeseries.tab', """
 # --- Not used ---
 
 
+
+# wait for all the tables to be written
+finish()
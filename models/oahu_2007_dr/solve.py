@@ -31,6 +31,10 @@ print "loading model..."
 # This may be a pyomo bug, but it's hard to work around in the short term.
 # Param.DefaultMutable = True
 
+# add each new demand bid as extra columns in the existing rows, instead of reconstructing
+# the energy balance and objective function every iteration (see demand_response.py)
+# demand_response.column_generation = True
+
 switch_model = define_AbstractModel(
     'switch_mod', 'fuel_cost', 'project.no_commit', #'project.unitcommit', 'project.unitcommit.discrete', 
     'demand_response', 'rps'
@@ -42,13 +46,30 @@ switch_instance = switch_model.load_inputs(inputs_dir="inputs_rps")
 
 results = None
 
+# maximum number of times to solve the model and add new demand bids
+max_iterations = 200
+# stop iterating when no marginal cost changes by more than price_tolerance (as a fraction of 
+# the average marginal cost) and no load changes by more than quantity_tolerance (as a fraction
+# of the average load) between solutions
+price_tolerance = 0.001
+quantity_tolerance = 0.001
+# remove bids that have had zero weight everywhere for this many solutions in a row
+# (None to keep all bids)
+prune_after = 10
+
 def iterate():
     global switch_model, switch_instance, results
     # NOTE: some evil magic in demand_response 
     # turns on bid adjusting behavior if "adj_bad_bids" is in the tag
     # or bid dropping behavior if "drop_bad_bids" is in the tag
     tag = 'accel_rps_fixed_ce_200'
-    for i in range(200):
+    convergence_file = os.path.join("outputs", "convergence_{t}.txt".format(t=tag))
+    util.create_table(
+        output_file=convergence_file,
+        headings=("iteration", "total_cost", "n_bids", "bids_pruned", "max_price_change", "max_quantity_change")
+    )
+    previous = None
+    for i in range(max_iterations):
         # solve the model repeatedly, iterating with a new demand function
         solve_once()
 
@@ -57,11 +78,62 @@ def iterate():
             write_results(tag=tag+'_'+str(i))
         
         #import pdb; pdb.set_trace()
-        
+
+        # compare prices and loads to the previous solution
+        current = market_state(switch_instance)
+        (price_change, quantity_change) = state_change(previous, current)
+        previous = current
+        converged = (
+            len(switch_instance.DR_BID_LIST) > 1 
+            and price_change <= price_tolerance and quantity_change <= quantity_tolerance
+        )
+
+        # drop bids that are no longer being used (before the next bid is added)
+        if prune_after is not None and not converged:
+            pruned = demand_response.prune_bids(switch_instance, prune_after, tag)
+        else:
+            pruned = []
+
+        print "iteration {i}: max price change={p:.6f}, max quantity change={q:.6f}, bids={b}, pruned={r}".format(
+            i=i, p=price_change, q=quantity_change, b=len(switch_instance.DR_BID_LIST), r=pruned)
+        util.append_table(None, output_file=convergence_file, values=lambda m: (
+            i, value(switch_instance.Minimize_System_Cost), len(switch_instance.DR_BID_LIST), 
+            len(pruned), price_change, quantity_change
+        ))
+
+        if converged:
+            print "prices and loads have converged after {n} iterations.".format(n=i+1)
+            if not (i <= 24 or i % 5 == 0):
+                write_results(tag=tag+'_'+str(i))
+            break
+
         print "attaching new demand bid to model"
         demand_response.update_demand(switch_instance, tag)
         switch_instance.preprocess()
 
+def market_state(m):
+    """Return dictionaries of the marginal cost and load in each load zone and timepoint."""
+    prices = {
+        (lz, tp): m.dual[m.Energy_Balance[lz, tp]]/m.bring_timepoint_costs_to_base_year[tp]
+            for lz in m.LOAD_ZONES for tp in m.TIMEPOINTS
+    }
+    # note: FlexibleDemand replaces the fixed load after the first bids are added
+    if 'FlexibleDemand' in m.LZ_Energy_Balance_components:
+        loads = {(lz, tp): -value(m.FlexibleDemand[lz, tp]) for lz in m.LOAD_ZONES for tp in m.TIMEPOINTS}
+    else:
+        loads = {(lz, tp): value(m.lz_demand_mw[lz, tp]) for lz in m.LOAD_ZONES for tp in m.TIMEPOINTS}
+    return (prices, loads)
+
+def state_change(previous, current):
+    """Return the largest change in price and load between two market states (from market_state()),
+    as fractions of the average price and load in the previous state."""
+    if previous is None:
+        return (float('inf'), float('inf'))
+    return tuple(
+        max(abs(cur[k] - prev[k]) for k in cur) / max(sum(abs(v) for v in prev.values()) / len(prev), 1e-6)
+            for (prev, cur) in zip(previous, current)
+    )
+
 def write_results(tag=None):
     if tag is not None:
         t = "_"+str(tag)
@@ -2,6 +2,7 @@ import bisect
 from pprint import pprint
 from pyomo.environ import *
 import switch_mod.utilities as utilities
+from slice_set import slice_set
 
 
 def define_components(m):
@@ -28,32 +29,34 @@ def define_components(m):
         return m.rps_targets[latest_target]
     m.rps_target_for_period = Param(m.PERIODS, initialize=rps_target_for_period_rule)
 
+    # dispatch points in each period, built in one pass (see slice_set.py)
+    m.PROJ_DISPATCH_POINTS_IN_PERIOD = Set(m.PERIODS, dimen=2, 
+        initialize=slice_set('PROJ_DISPATCH_POINTS', index=lambda m, proj, tp: m.tp_period[tp]))
+
     m.RPS_Enforce = Constraint(m.PERIODS, rule=lambda m, per:
         ( # RE Sources
             sum(
                 m.DispatchProj[proj, tp] 
-                for proj, tp in m.PROJ_DISPATCH_POINTS
-                if m.tp_period[tp] == per and proj in m.FUEL_BASED_PROJECTS and m.proj_fuel[proj] in m.RPS_ENERGY_SOURCES
+                for proj, tp in m.PROJ_DISPATCH_POINTS_IN_PERIOD[per]
+                if proj in m.FUEL_BASED_PROJECTS and m.proj_fuel[proj] in m.RPS_ENERGY_SOURCES
             )
             +
             sum(
                 m.DispatchProj[proj, tp] 
-                for proj, tp in m.PROJ_DISPATCH_POINTS
-                if m.tp_period[tp] == per and proj in m.NON_FUEL_BASED_PROJECTS and m.proj_non_fuel_energy_source[proj] in m.RPS_ENERGY_SOURCES
+                for proj, tp in m.PROJ_DISPATCH_POINTS_IN_PERIOD[per]
+                if proj in m.NON_FUEL_BASED_PROJECTS and m.proj_non_fuel_energy_source[proj] in m.RPS_ENERGY_SOURCES
             )
             +
             sum(    # assume DumpPower is curtailed renewable energy (note: DumpPower is negative)
                 m.DumpPower[lz, tp]
-                for lz in m.LOAD_ZONES for tp in m.TIMEPOINTS
-                if m.tp_period[tp] == per
+                for lz in m.LOAD_ZONES for tp in m.PERIOD_TPS[per]
             )
         )
         >=
         m.rps_target_for_period[per] 
         * sum(  # all energy sources
             m.DispatchProj[proj, tp] 
-            for (proj, tp) in m.PROJ_DISPATCH_POINTS
-            if m.tp_period[tp] == per
+            for (proj, tp) in m.PROJ_DISPATCH_POINTS_IN_PERIOD[per]
         )
     )
 
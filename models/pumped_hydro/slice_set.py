@@ -0,0 +1,93 @@
+"""
+Helper for defining indexed sets that are slices of a larger set, e.g., the members of
+RFM_SUPPLY_TIERS for each period, or the dispatch points for each project.
+
+The obvious way to define these is to filter the parent set once for each index,
+e.g., Set(m.PERIODS, initialize=lambda m, p: [(r, _p, st) for (r, _p, st) in m.RFM_SUPPLY_TIERS if _p == p]),
+but that takes time proportional to (number of indexes) x (size of parent set).
+slice_set() instead sorts all the members of the parent set into slices in a single
+pass the first time the indexed set asks for a slice, and then hands out the slices
+(popping them from a dictionary, so the memory is released as it goes).
+
+Example:
+
+    from slice_set import slice_set
+    m.RFM_SUPPLY_TIERS_IN_PERIOD = Set(m.PERIODS, dimen=3,
+        initialize=slice_set('RFM_SUPPLY_TIERS', index=(1,)))
+    m.PROJECTS_BY_FUEL_IN_PERIOD = Set(m.FUELS, m.PERIODS,
+        initialize=slice_set('PROJ_FUEL_DISPATCH_POINTS',
+            index=lambda m, p, t, f: (f, m.tp_period[t]), value=(0,)))
+
+The slices are stored on the model instance (not in the function), so the same rule
+can be used for several instances, and they are rebuilt from the current contents of
+the parent set if the indexed set is constructed again (e.g., via reconstruct()).
+"""
+
+import itertools
+
+# used to give each slice_set rule its own entry in the model's cache
+_rule_ids = itertools.count()
+
+def _columns(cols):
+    """Convert a column spec (int, tuple of ints or function) into a function of (m, row)."""
+    if cols is None:
+        return lambda m, row: row[0] if len(row) == 1 else row
+    if callable(cols):
+        return lambda m, row: cols(m, *row)
+    if isinstance(cols, int):
+        cols = (cols,)
+    if len(cols) == 1:
+        c = cols[0]
+        return lambda m, row: row[c]
+    return lambda m, row: tuple(row[c] for c in cols)
+
+def slice_set(parent, index, value=None, filter=None):
+    """Return an initialize rule for an indexed Set, whose members for each index are
+    drawn from the parent set.
+
+    parent: name of a set in the model (e.g., 'PROJ_DISPATCH_POINTS'), or a function 
+        that accepts the model and returns an iterable of rows.
+    index: column(s) of each row of the parent set that identify the index it belongs to
+        (an int or tuple of ints), or a function that accepts (m, *row) and returns the index.
+    value: column(s) of each row to use as the member of the slice (default is the whole row),
+        or a function that accepts (m, *row) and returns the member.
+    filter: optional function that accepts (m, *row) and returns True if the row
+        should be included.
+
+    Duplicate members are dropped from each slice (keeping the first occurrence), and
+    indexes with no matching rows get an empty slice."""
+    rule_id = next(_rule_ids)
+    get_index = _columns(index)
+    get_value = _columns(value)
+
+    def build(m):
+        # note: the parent is looked up by name, so we always get the version in this instance
+        rows = getattr(m, parent) if isinstance(parent, basestring) else parent(m)
+        slices = {}
+        seen = set()
+        for row in rows:
+            row = row if isinstance(row, tuple) else (row,)
+            if filter is not None and not filter(m, *row):
+                continue
+            idx = get_index(m, row)
+            val = get_value(m, row)
+            if (idx, val) not in seen:
+                seen.add((idx, val))
+                slices.setdefault(idx, []).append(val)
+        return slices
+
+    def rule(m, *idx):
+        idx = idx[0] if len(idx) == 1 else idx
+        cache = getattr(m, '_slice_set_cache', None)
+        if cache is None:
+            cache = m._slice_set_cache = {}
+        state = cache.get(rule_id)
+        # note: each index is requested once per construction of the indexed set, so a
+        # repeat request means the set is being constructed again and the parent set
+        # may have changed since the slices were built
+        if state is None or idx in state["served"]:
+            state = cache[rule_id] = dict(slices=build(m), served=set())
+        state["served"].add(idx)
+        return state["slices"].pop(idx, [])
+
+    return rule
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 import argparse
+import job_queue
 
 def iterify(item):
     """Return an iterable for the one or more items passed."""
@@ -120,21 +121,16 @@ def main():
     #     print "running next scenario"
 
 
-def scenario_already_run(scenario):
-    """Add the specified scenario to the list in completed_scenarios.txt. Return False if it wasn't there already."""
-    with open('completed_scenarios.txt', 'a+') as f:
-        # wait for exclusive access to the list (to avoid writing the same scenario twice in a race condition)
-        fcntl.flock(f, fcntl.LOCK_EX)
-        # file starts with pointer at end; move to start
-        f.seek(0, 0)                    
-        if scenario + '\n' in f:
-            already_run = True
-        else:
-            already_run = False
-            # append name to the list (will always go at end, because file was opened in 'a' mode)
-            f.write(scenario + '\n')
-        fcntl.flock(f, fcntl.LOCK_UN)
-    return already_run
+def scenario_already_run(scenario, queue_file='scenario_queue.sqlite'):
+    """Return True if the specified scenario has already been completed or is currently
+    running in another process, according to the job queue. This only checks the queue; 
+    the process that runs the scenario should claim it with job_queue.claim_job() and 
+    run it inside job_queue.running_job(), so it is marked as done when it finishes."""
+    con = job_queue.connect(queue_file)
+    job_queue.requeue_expired(con)
+    states = {s: state for (s, state, attempts, worker, error) in job_queue.job_states(con)}
+    con.close()
+    return states.get(scenario) in ('done', 'running')
 
 if __name__ == "__main__":
     main()
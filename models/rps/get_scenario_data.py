@@ -342,6 +342,10 @@ alt_args = [
 for a in alt_args:
     # clone the arguments dictionary and update it with settings from the alt_args entry, if any
     active_args = dict(args.items() + a.items())
+    if active_args.get('inputs_subdir'):
+        # tables that would be the same as in the base inputs directory are hard-linked 
+        # from there instead of being queried again (the base scenario is written first)
+        active_args['base_dir'] = args['inputs_dir']
     scenario_data.write_tables(**active_args)
     
 
@@ -0,0 +1,187 @@
+"""
+Caches the parsed contents of .tab input files, so they don't have to be parsed
+again for every scenario.
+
+While the cached_tab_files() context manager is active, each call to DataPortal.load()
+for a .tab file (normally made by switch's load_aug() from within the modules'
+load_inputs() functions) is looked up in a cache directory inside the inputs directory.
+If the file's path, modification time and size and the load arguments all match a
+cached entry, the data are loaded from the cache (a binary pickle) instead of parsing
+the file. Otherwise the file is parsed as usual and the result is added to the cache.
+
+If workers > 1, the load() calls are deferred instead, and the .tab files that aren't
+in the cache are parsed in a pool of worker processes just before the model instance
+is created (i.e., when create_instance() or create() is called on any model, or at the
+end of the with block). The results are then merged into the DataPortal in the order
+the files were originally loaded, so later files override earlier ones as usual.
+(This assumes nothing reads the DataPortal between loading the files and creating the
+instance, which is how switch's load_inputs() works.)
+
+Typical use:
+
+    with input_loader.cached_tab_files(inputs_dir, workers=4):
+        instance = model.load_inputs(inputs_dir=inputs_dir)
+"""
+
+import os, hashlib, multiprocessing
+import cPickle as pickle
+from contextlib import contextmanager
+
+from pyomo.environ import *
+
+# name of the directory (inside the inputs directory) that holds the cached data
+cache_dir_name = '.cache'
+
+# increment this to invalidate all previously cached data (e.g., after upgrading Pyomo)
+cache_version = 1
+
+def _arg_key(v):
+    """Convert a load() argument into a form that doesn't depend on the model instance
+    (model components are identified by name)."""
+    if isinstance(v, (list, tuple)):
+        return tuple(_arg_key(x) for x in v)
+    if hasattr(v, 'cname'):
+        return ('component', v.cname())
+    return v
+
+def cache_file(cache_dir, filename, kwds):
+    """Return the name of the cache file for loading filename with the specified arguments."""
+    st = os.stat(filename)
+    key = repr((
+        cache_version,
+        os.path.abspath(filename), st.st_mtime, st.st_size,
+        sorted((k, _arg_key(v)) for (k, v) in kwds.iteritems() if k != 'filename')
+    ))
+    return os.path.join(
+        cache_dir,
+        '{f}.{h}.pickle'.format(f=os.path.basename(filename), h=hashlib.sha1(key).hexdigest())
+    )
+
+def read_cache(cache_file):
+    """Return the cached data for a file, or None if it isn't in the cache."""
+    if not os.path.isfile(cache_file):
+        return None
+    try:
+        with open(cache_file, 'rb') as f:
+            return pickle.load(f)
+    except Exception:
+        # damaged or incompatible cache file; just parse the original again
+        return None
+
+def write_cache(cache_file, data):
+    """Save data in the cache (written to a temporary file first, so other processes
+    never see a partial file)."""
+    cache_dir = os.path.dirname(cache_file)
+    if not os.path.isdir(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            pass    # may have been created by another process
+    tmp_file = cache_file + '.tmp{p}'.format(p=os.getpid())
+    with open(tmp_file, 'wb') as f:
+        pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+    os.rename(tmp_file, cache_file)
+
+def parse_tab_file(load, model, kwds):
+    """Parse a file into a new DataPortal using the standard load() function,
+    and return the data that were loaded (the DataPortal's _data dictionary)."""
+    tmp = DataPortal(model=model)
+    load(tmp, **kwds)
+    return tmp._data
+
+def merge_data(data_portal, data):
+    """Add the data from one file to a DataPortal (later files override earlier ones,
+    as they would if they were loaded directly)."""
+    for (namespace, components) in data.iteritems():
+        data_portal._data.setdefault(namespace, {}).update(components)
+
+# deferred load() calls, as (data_portal, kwds, cache_file) tuples (cache_file is None
+# for files that aren't cached); this is a global so forked worker processes can see it
+_pending = []
+_original_load = None
+
+def _parse_pending(i):
+    """Parse one of the deferred files and save it in the cache (runs in a worker process)."""
+    (data_portal, kwds, f) = _pending[i]
+    data = parse_tab_file(_original_load, getattr(data_portal, '_model', None), kwds)
+    write_cache(f, data)
+    return data
+
+def flush_pending(workers):
+    """Carry out all deferred load() calls, parsing uncached .tab files in parallel."""
+    if len(_pending) == 0:
+        return
+    parsed = {}
+    misses = [i for (i, (d, kwds, f)) in enumerate(_pending) if f is not None and not os.path.isfile(f)]
+    if len(misses) > 1 and workers > 1:
+        # note: the pool is created after _pending is filled, so the forked workers inherit it
+        pool = multiprocessing.Pool(min(workers, len(misses)))
+        try:
+            parsed = dict(zip(misses, pool.map(_parse_pending, misses, chunksize=1)))
+        finally:
+            pool.close()
+            pool.join()
+    # merge everything in the original order
+    for (i, (data_portal, kwds, f)) in enumerate(_pending):
+        if f is None:
+            _original_load(data_portal, **kwds)
+        else:
+            data = parsed.get(i)
+            if data is None:
+                data = read_cache(f)
+            if data is None:
+                data = _parse_pending(i)
+            merge_data(data_portal, data)
+    del _pending[:]
+
+@contextmanager
+def cached_tab_files(inputs_dir, workers=1):
+    """Use the cache for all .tab files loaded into any DataPortal while the body runs.
+    If workers > 1, uncached files are parsed in parallel in that many processes."""
+    global _original_load
+    cache_dir = os.path.join(inputs_dir, cache_dir_name)
+    _original_load = original_load = DataPortal.load
+
+    def load(self, **kwds):
+        filename = kwds.get('filename')
+        if filename is None or not filename.endswith('.tab') or not os.path.isfile(filename):
+            f = None
+        else:
+            f = cache_file(cache_dir, filename, kwds)
+        if workers > 1:
+            # defer until the data are needed (non-.tab files too, to keep everything in order)
+            _pending.append((self, kwds, f))
+        elif f is None:
+            original_load(self, **kwds)
+        else:
+            data = read_cache(f)
+            if data is None:
+                data = parse_tab_file(original_load, getattr(self, '_model', None), kwds)
+                write_cache(f, data)
+            merge_data(self, data)
+    DataPortal.load = load
+
+    # make sure the deferred files are loaded before any model instance is created
+    def flush_before(original):
+        def create(self, *args, **kwds):
+            flush_pending(workers)
+            return original(self, *args, **kwds)
+        return create
+    patched = []
+    if workers > 1:
+        for name in ['create_instance', 'create']:
+            if hasattr(AbstractModel, name):
+                original = getattr(AbstractModel, name)
+                patched.append((name, name in AbstractModel.__dict__, original))
+                setattr(AbstractModel, name, flush_before(original))
+    try:
+        yield
+        flush_pending(workers)
+    finally:
+        del _pending[:]
+        DataPortal.load = original_load
+        for (name, was_local, original) in patched:
+            if was_local:
+                setattr(AbstractModel, name, original)
+            else:
+                delattr(AbstractModel, name)
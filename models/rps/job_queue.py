@@ -0,0 +1,213 @@
+"""
+Keeps track of which scenarios are queued, running, done or failed, using a small
+SQLite database that can be shared by any number of solve.py processes on the same
+machine. This replaces the older completed_scenarios.txt approach, which marked a
+scenario as done as soon as it started, so scenarios were lost if a worker crashed.
+
+Each running scenario holds a lease, which the worker renews periodically
+(heartbeat). If a worker dies, its lease expires and the scenario is returned
+to the queue the next time any worker looks for a job.
+
+Typical use:
+
+    con = job_queue.connect('scenario_queue.sqlite')
+    job_queue.add_job(con, 'base', dict(scenario_name='base'))
+    job = job_queue.claim_next_job(con)
+    if job is not None:
+        (scenario, args) = job
+        with job_queue.running_job('scenario_queue.sqlite', scenario):
+            solve(**args)
+"""
+
+import os, sys, time, json, socket, sqlite3, threading
+from contextlib import contextmanager
+
+# running jobs that haven't renewed their lease for this long are assumed to be dead
+lease_seconds = 600
+# how often running jobs renew their lease
+heartbeat_seconds = 60
+# number of times a job can be started before it is marked as failed instead of requeued
+max_attempts = 3
+# how often idle workers check for jobs that have been returned to the queue
+poll_seconds = 10
+
+def worker_id():
+    """Return an identifier for the current process, e.g., 'myhost:1234'."""
+    return '{h}:{p}'.format(h=socket.gethostname(), p=os.getpid())
+
+def connect(db_file='scenario_queue.sqlite'):
+    """Open (and create if needed) the job database."""
+    # note: isolation_level=None turns off the implicit transactions in the sqlite3 module;
+    # we start transactions explicitly with BEGIN IMMEDIATE so that checking and claiming
+    # a job happen atomically, even when several processes are using the database.
+    con = sqlite3.connect(db_file, timeout=60, isolation_level=None)
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            scenario TEXT PRIMARY KEY,
+            args TEXT,
+            state TEXT NOT NULL DEFAULT 'queued',   -- queued, running, done or failed
+            worker TEXT,
+            lease_expires REAL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            queued REAL,
+            started REAL,
+            finished REAL,
+            error TEXT
+        );
+    """)
+    return con
+
+@contextmanager
+def transaction(con):
+    con.execute("BEGIN IMMEDIATE;")
+    try:
+        yield con
+        con.execute("COMMIT;")
+    except:
+        con.execute("ROLLBACK;")
+        raise
+
+def add_job(con, scenario, args=None, requeue=False):
+    """Add a scenario to the queue, if it isn't there already. If requeue is True,
+    also send it back to the queue if it is done or failed (but not if it is running).
+    Returns True if the scenario was (re)queued."""
+    now = time.time()
+    with transaction(con):
+        row = con.execute("SELECT state FROM jobs WHERE scenario=?;", (scenario,)).fetchone()
+        if row is None:
+            con.execute(
+                "INSERT INTO jobs (scenario, args, state, queued) VALUES (?, ?, 'queued', ?);",
+                (scenario, json.dumps(args), now)
+            )
+            return True
+        elif requeue and row[0] in ('done', 'failed'):
+            con.execute("""
+                UPDATE jobs SET args=?, state='queued', worker=NULL, lease_expires=NULL,
+                    attempts=0, queued=?, started=NULL, finished=NULL, error=NULL
+                WHERE scenario=?;
+            """, (json.dumps(args), now, scenario))
+            return True
+        else:
+            return False
+
+def requeue_expired(con):
+    """Return running jobs whose leases have expired to the queue (or mark them as failed
+    if they have already been tried max_attempts times). Returns the list of affected scenarios."""
+    now = time.time()
+    with transaction(con):
+        expired = con.execute(
+            "SELECT scenario, worker, attempts FROM jobs WHERE state='running' AND lease_expires < ?;",
+            (now,)
+        ).fetchall()
+        for (scenario, worker, attempts) in expired:
+            if attempts >= max_attempts:
+                print "job queue: lease expired for scenario {s} (worker {w}); giving up after {a} attempts.".format(
+                    s=scenario, w=worker, a=attempts)
+                con.execute("""
+                    UPDATE jobs SET state='failed', finished=?, lease_expires=NULL,
+                        error='lease expired (worker ' || worker || ')'
+                    WHERE scenario=?;
+                """, (now, scenario))
+            else:
+                print "job queue: lease expired for scenario {s} (worker {w}); returning it to the queue.".format(
+                    s=scenario, w=worker)
+                con.execute("""
+                    UPDATE jobs SET state='queued', worker=NULL, lease_expires=NULL
+                    WHERE scenario=?;
+                """, (scenario,))
+    return [e[0] for e in expired]
+
+def _start(con, scenario, worker, lease):
+    now = time.time()
+    con.execute("""
+        UPDATE jobs SET state='running', worker=?, lease_expires=?, attempts=attempts+1,
+            started=?, finished=NULL, error=NULL
+        WHERE scenario=?;
+    """, (worker, now + lease, now, scenario))
+
+def claim_next_job(con, worker=None, lease=None):
+    """Claim the oldest queued job. Returns a (scenario, args) tuple, or None if no jobs are queued."""
+    worker = worker_id() if worker is None else worker
+    lease = lease_seconds if lease is None else lease
+    requeue_expired(con)
+    with transaction(con):
+        row = con.execute(
+            "SELECT scenario, args FROM jobs WHERE state='queued' ORDER BY queued, rowid LIMIT 1;"
+        ).fetchone()
+        if row is None:
+            return None
+        _start(con, row[0], worker, lease)
+    return (row[0], json.loads(row[1]))
+
+def claim_job(con, scenario, args=None, worker=None, lease=None):
+    """Claim a specific scenario, adding it to the queue if needed. Returns False
+    (without claiming it) if the scenario is already done or is running with a live lease."""
+    worker = worker_id() if worker is None else worker
+    lease = lease_seconds if lease is None else lease
+    add_job(con, scenario, args)
+    requeue_expired(con)
+    with transaction(con):
+        (state,) = con.execute("SELECT state FROM jobs WHERE scenario=?;", (scenario,)).fetchone()
+        if state in ('done', 'running'):
+            return False
+        _start(con, scenario, worker, lease)
+    return True
+
+def heartbeat(con, scenario, worker=None, lease=None):
+    """Renew the lease on a running job. Returns False if the job is no longer held by this worker."""
+    worker = worker_id() if worker is None else worker
+    lease = lease_seconds if lease is None else lease
+    with transaction(con):
+        cur = con.execute(
+            "UPDATE jobs SET lease_expires=? WHERE scenario=? AND worker=? AND state='running';",
+            (time.time() + lease, scenario, worker)
+        )
+        return cur.rowcount > 0
+
+def finish_job(con, scenario, worker=None, error=None):
+    """Mark a job as done (or failed, if an error message is given)."""
+    worker = worker_id() if worker is None else worker
+    with transaction(con):
+        con.execute("""
+            UPDATE jobs SET state=?, finished=?, lease_expires=NULL, error=?
+            WHERE scenario=? AND worker=?;
+        """, ('done' if error is None else 'failed', time.time(), error, scenario, worker))
+
+def unfinished_jobs(con):
+    """Return the number of jobs that are queued or running (including running jobs whose
+    leases have expired, which will be returned to the queue)."""
+    return con.execute("SELECT COUNT(*) FROM jobs WHERE state IN ('queued', 'running');").fetchone()[0]
+
+def job_states(con):
+    """Return a list of (scenario, state, attempts, worker, error) tuples for all jobs."""
+    return con.execute(
+        "SELECT scenario, state, attempts, worker, error FROM jobs ORDER BY queued, rowid;"
+    ).fetchall()
+
+@contextmanager
+def running_job(db_file, scenario, worker=None):
+    """Renew the lease on a claimed job in a background thread while the body runs,
+    then mark the job as done, or as failed if the body raises an exception."""
+    worker = worker_id() if worker is None else worker
+    stop = threading.Event()
+    def renew():
+        # sqlite connections can't be shared between threads, so we open our own
+        con = connect(db_file)
+        while not stop.wait(heartbeat_seconds):
+            heartbeat(con, scenario, worker)
+        con.close()
+    thread = threading.Thread(target=renew, name='heartbeat ' + scenario)
+    thread.daemon = True
+    thread.start()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = '{t}: {e}'.format(t=type(e).__name__, e=e)
+        raise
+    finally:
+        stop.set()
+        thread.join()
+        con = connect(db_file)
+        finish_job(con, scenario, worker, error)
+        con.close()
@@ -0,0 +1,70 @@
+"""
+Runs output jobs (formatting and writing tables) in a background thread, so the main
+thread can move on to the next solve while the files are written.
+
+Jobs are run one at a time, in the order they were submitted. The caller is responsible
+for taking a snapshot of any model data the job needs (e.g., calculating the rows of a
+table) before submitting it, since the model may change while the job waits in the queue.
+If a job fails, the exception is raised in the main thread the next time submit() or
+flush() is called, and later jobs are skipped.
+
+Typical use:
+
+    rows = [...]    # plain values, calculated from the model
+    output_writer.submit(util.write_table, None, rows, output_file=..., headings=...,
+        values=lambda m, row: row)
+    ...
+    output_writer.flush()   # wait for all the files to be written
+"""
+
+import os, sys, threading, atexit
+import Queue
+
+_queue = None
+_error = None
+_pid = None
+
+def _run(queue):
+    global _error
+    while True:
+        (fn, args, kwargs) = queue.get()
+        try:
+            if _error is None:
+                fn(*args, **kwargs)
+        except BaseException:
+            _error = sys.exc_info()
+        finally:
+            queue.task_done()
+
+def _start():
+    """Start the writer thread (again, if this is a new process forked from the one that started it)."""
+    global _queue, _pid
+    if _queue is None or _pid != os.getpid():
+        _queue = Queue.Queue()
+        _pid = os.getpid()
+        thread = threading.Thread(target=_run, args=(_queue,), name='output writer')
+        # note: this is a daemon thread so it can't keep the process alive on its own;
+        # flush() is registered with atexit so pending jobs are finished before exiting
+        thread.daemon = True
+        thread.start()
+
+def _raise_error():
+    global _error
+    if _error is not None:
+        (t, e, tb) = _error
+        _error = None
+        raise t, e, tb
+
+def submit(fn, *args, **kwargs):
+    """Run fn(*args, **kwargs) in the background writer thread."""
+    _raise_error()
+    _start()
+    _queue.put((fn, args, kwargs))
+
+def flush():
+    """Wait until all submitted jobs have finished, and raise any error that occurred."""
+    if _queue is not None and _pid == os.getpid():
+        _queue.join()
+    _raise_error()
+
+atexit.register(flush)
@@ -0,0 +1,129 @@
+"""
+Nested timing and memory measurements for the phases of a model run.
+
+Each span records its wall-clock time and the process's resident memory (RSS) at the
+start and end, plus the peak RSS reached so far (resource.getrusage; if this rises
+during a span, that span set a new high-water mark). Spans can be nested, and
+component_construction() adds a span for every Pyomo component (Set, Param, Var,
+Constraint, etc.) that is constructed while it is active.
+
+Typical use:
+
+    profiling.reset()
+    with profiling.span('load inputs'):
+        with profiling.component_construction():
+            instance = model.load_inputs(inputs_dir=inputs_dir)
+    profiling.write('outputs/timing.json')
+"""
+
+import os, sys, time, json, resource
+from contextlib import contextmanager
+
+from pyomo.core.base.component import Component
+
+_page_size = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+# completed top-level spans and the stack of currently open spans
+_spans = []
+_stack = []
+_start_time = time.time()
+
+def rss_mb():
+    """Return the current resident memory of this process in MB (None if unavailable)."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * _page_size / 1048576.0
+    except (IOError, OSError):
+        return None
+
+def peak_rss_mb():
+    """Return the peak resident memory of this process so far, in MB."""
+    # note: ru_maxrss is in bytes on OS X and kB on Linux
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / (1048576.0 if sys.platform == 'darwin' else 1024.0)
+
+def reset():
+    """Discard all recorded spans (e.g., at the start of a new scenario)."""
+    global _start_time
+    del _spans[:]
+    del _stack[:]
+    _start_time = time.time()
+
+@contextmanager
+def span(name):
+    """Record the time and memory used while the body runs."""
+    s = dict(
+        name=name,
+        start=round(time.time() - _start_time, 3),
+        rss_start_mb=rss_mb(),
+        children=[]
+    )
+    (_stack[-1]["children"] if _stack else _spans).append(s)
+    _stack.append(s)
+    t = time.time()
+    try:
+        yield s
+    finally:
+        s["seconds"] = round(time.time() - t, 3)
+        s["rss_end_mb"] = rss_mb()
+        s["peak_rss_mb"] = peak_rss_mb()
+        # note: spans always close in the reverse order they were opened
+        _stack.pop()
+
+def _component_name(c):
+    return c.cname() if hasattr(c, 'cname') else c.name
+
+def _component_classes(cls=Component):
+    for c in cls.__subclasses__():
+        yield c
+        for sub in _component_classes(c):
+            yield sub
+
+@contextmanager
+def component_construction():
+    """Add a span for each Pyomo component constructed while the body runs."""
+    constructing = set()
+    def timed(construct):
+        def timed_construct(self, *args, **kwds):
+            # note: subclasses often call their parent class's construct(), so we
+            # only record the outermost call for each component
+            if id(self) in constructing:
+                return construct(self, *args, **kwds)
+            constructing.add(id(self))
+            try:
+                with span('construct {t} {n}'.format(t=type(self).__name__, n=_component_name(self))):
+                    return construct(self, *args, **kwds)
+            finally:
+                constructing.discard(id(self))
+        return timed_construct
+    patched = []
+    for cls in set(_component_classes()):
+        if 'construct' in cls.__dict__:
+            patched.append((cls, cls.__dict__['construct']))
+            cls.construct = timed(cls.__dict__['construct'])
+    try:
+        yield
+    finally:
+        for (cls, construct) in patched:
+            cls.construct = construct
+
+def spans():
+    """Return the recorded spans (a list of nested dictionaries)."""
+    return _spans
+
+def write(output_file):
+    """Save the recorded spans as JSON."""
+    with open(output_file, 'w') as f:
+        json.dump(dict(spans=_spans), f, indent=1)
+
+def summary(min_seconds=1.0):
+    """Return a flat list of (depth, name, seconds, peak_rss_mb) for spans that took
+    at least min_seconds, for a quick look at the slow parts of a run."""
+    rows = []
+    def add(spans, depth):
+        for s in spans:
+            if s.get("seconds", 0.0) >= min_seconds:
+                rows.append((depth, s["name"], s["seconds"], s.get("peak_rss_mb")))
+                add(s["children"], depth + 1)
+    add(_spans, 0)
+    return rows
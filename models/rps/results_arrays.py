@@ -0,0 +1,132 @@
+"""
+Helpers for pulling solved values out of a model instance into NumPy arrays, so output
+tables can be calculated with array operations instead of evaluating expressions for
+each cell.
+
+Each indexed component is read in a single pass. Index values are mapped to positions
+along each axis using lists of the members of the indexing sets (e.g., list(m.TIMEPOINTS)),
+and axes given as None are summed out. Relationships between sets (e.g., which projects
+use each energy source) are represented as sparse 0/1 incidence matrices, so aggregating
+over them is a matrix product.
+
+Example:
+
+    tps = list(m.TIMEPOINTS)
+    # total dispatch of each fuel in each timepoint (timepoints x fuels)
+    fuel_dispatch = component_array(m.DispatchProjByFuel, [None, tps, list(m.FUELS)])
+    # dispatch by project (projects x timepoints)
+    dispatch = component_array(m.DispatchProj, [list(m.PROJECTS), tps])
+    # dispatch by non-fuel energy source (sources x timepoints)
+    sources = incidence(list(m.NON_FUEL_ENERGY_SOURCES), list(m.PROJECTS),
+        (s, p) for s in m.NON_FUEL_ENERGY_SOURCES for p in m.PROJECTS_BY_NON_FUEL_ENERGY_SOURCE[s])
+    source_dispatch = sources.dot(dispatch)
+
+For tables that aggregate projects by their attributes (load zone, technology, energy
+source), project_attributes() gathers those attributes once, and group_sum() totals
+any per-project values by any combination of them in a single pass.
+"""
+
+from collections import defaultdict
+import numpy as np
+from pyomo.environ import value
+from util import get
+
+def positions(items):
+    """Return a dictionary showing the position of each item in a list."""
+    return {x: i for (i, x) in enumerate(items)}
+
+def _value(v):
+    try:
+        return value(v)
+    except ValueError:
+        # variable without a value (e.g., not used in the model)
+        return np.nan
+
+def component_array(component, axes, default=0.0, get_value=_value):
+    """Return a dense array of the values of an indexed component (Var, Expression, Param, etc.).
+    axes is a list with one entry per index column: either a list of the index values
+    that should be used along that axis of the array, or None to sum over that column.
+    Elements with index values that aren't in the axes are ignored, and positions
+    with no matching element get the default value."""
+    kept = [i for (i, a) in enumerate(axes) if a is not None]
+    maps = [positions(axes[i]) for i in kept]
+    shape = tuple(len(axes[i]) for i in kept)
+    cols = [[] for i in kept]
+    vals = []
+    for (idx, v) in component.iteritems():
+        idx = idx if isinstance(idx, tuple) else (idx,)
+        try:
+            pos = [maps[j][idx[i]] for (j, i) in enumerate(kept)]
+        except KeyError:
+            continue
+        for (c, p) in zip(cols, pos):
+            c.append(p)
+        vals.append(get_value(v))
+    arr = np.full(shape, default, dtype=float)
+    if len(vals) > 0:
+        if len(kept) < len(axes):
+            arr[tuple(np.array(c) for c in cols)] = 0.0
+            np.add.at(arr, tuple(np.array(c) for c in cols), vals)
+        else:
+            arr[tuple(np.array(c) for c in cols)] = vals
+    return arr
+
+def dual_array(m, constraint, axes, default=0.0):
+    """Return an array of the duals of an indexed constraint (or the default value
+    if no dual is available, e.g., with the glpk solver)."""
+    return component_array(constraint, axes, default=default,
+        get_value=lambda c: get(m.dual, c, default))
+
+class Incidence(object):
+    """Sparse 0/1 matrix, stored as the row and column positions of its 1's."""
+    def __init__(self, rows, cols, shape):
+        self.rows = np.asarray(rows, dtype=int)
+        self.cols = np.asarray(cols, dtype=int)
+        self.shape = shape
+
+    def dot(self, arr):
+        """Return the matrix product of this matrix and arr (which must have one row
+        for each column of this matrix), e.g., totals by energy source from an array
+        of values by project."""
+        arr = np.asarray(arr, dtype=float)
+        result = np.zeros((self.shape[0],) + arr.shape[1:])
+        np.add.at(result, self.rows, arr[self.cols])
+        return result
+
+def incidence(rows, cols, pairs):
+    """Return a sparse 0/1 matrix (Incidence) with a 1 at (row, col) for each (row, col) 
+    pair in pairs."""
+    row_pos = positions(rows)
+    col_pos = positions(cols)
+    ones = sorted(set((row_pos[r], col_pos[c]) for (r, c) in pairs))
+    return Incidence([r for (r, c) in ones], [c for (r, c) in ones], (len(rows), len(cols)))
+
+def project_attributes(m, energy_source):
+    """Return a dictionary with the load zone, technology, energy source and build years
+    of each project. energy_source is a function that returns the energy source label
+    for a technology (it is only called once per technology)."""
+    build_years = defaultdict(list)
+    for (pr, bld_yr) in m.PROJECT_BUILDYEARS:
+        build_years[pr].append(bld_yr)
+    tech_energy_source = {}
+    attributes = {}
+    for pr in m.PROJECTS:
+        tech = m.proj_gen_tech[pr]
+        if tech not in tech_energy_source:
+            tech_energy_source[tech] = energy_source(tech)
+        attributes[pr] = dict(
+            zone=m.proj_load_zone[pr],
+            tech=tech,
+            energy_source=tech_energy_source[tech],
+            build_years=build_years[pr]
+        )
+    return attributes
+
+def group_sum(rows, key, value):
+    """Total value(row) for all the rows, grouped by key(row). Returns a dictionary
+    of totals; groups with no rows are missing (so use .get(k, 0) to look them up)."""
+    totals = {}
+    for r in rows:
+        k = key(r)
+        totals[k] = totals.get(k, 0) + value(r)
+    return totals
@@ -0,0 +1,180 @@
+"""
+Columnar store for the output tables from a batch of scenarios.
+
+All the tables for all the scenarios in a batch are kept in one SQLite file (by default
+outputs/results.sqlite). Each column of each table is stored separately, in compressed
+chunks of up to chunk_rows values: float columns as packed arrays of doubles, other
+columns (including any with missing values) as JSON lists. All the tables for one scenario are written in a single
+transaction, so readers never see a partially written scenario, and several processes
+can add scenarios to the same file.
+
+Reading one table for all scenarios only touches the chunks for that table, e.g.,
+
+    import results_store
+    results_store.list_scenarios('outputs/results.sqlite')
+    (headings, rows) = results_store.read_table('outputs/results.sqlite', 'energy_sources')
+    df = results_store.read_dataframe('outputs/results.sqlite', 'cost_breakdown')   # needs pandas
+
+or, to make a single tab-separated file for Excel:
+
+    python results_store.py outputs/results.sqlite cost_breakdown cost_breakdown_all.tsv
+"""
+
+import sys, time, json, zlib, sqlite3, csv
+from array import array
+
+# maximum number of values in each compressed chunk
+chunk_rows = 65536
+
+def connect(store_file):
+    """Open (and create if needed) a results store."""
+    # note: transactions are started explicitly (see write_scenario)
+    con = sqlite3.connect(store_file, timeout=60, isolation_level=None)
+    con.executescript("""
+        CREATE TABLE IF NOT EXISTS scenarios (
+            scenario TEXT PRIMARY KEY,
+            written REAL
+        );
+        CREATE TABLE IF NOT EXISTS chunks (
+            scenario TEXT NOT NULL,
+            table_name TEXT NOT NULL,
+            position INTEGER NOT NULL,  -- column number within the table
+            column_name TEXT NOT NULL,
+            chunk INTEGER NOT NULL,
+            kind TEXT NOT NULL,         -- 'float' or 'json'
+            n_rows INTEGER NOT NULL,
+            data BLOB NOT NULL,
+            PRIMARY KEY (table_name, scenario, position, chunk)
+        );
+        CREATE INDEX IF NOT EXISTS chunks_scenario ON chunks (scenario);
+    """)
+    return con
+
+def _is_number(v):
+    return isinstance(v, (int, long, float)) and not isinstance(v, bool)
+
+def encode(values):
+    """Compress a list of values; returns (kind, data)."""
+    if all(_is_number(v) for v in values) \
+            and not all(isinstance(v, (int, long)) for v in values):
+        # floats (integer-only columns like period are kept exact as JSON instead, and so are
+        # columns with missing values, so None is returned as None rather than nan)
+        data = array('d', values).tostring()
+        return ('float', zlib.compress(data))
+    return ('json', zlib.compress(json.dumps(values)))
+
+def decode(kind, data):
+    """Decompress a list of values stored by encode()."""
+    data = zlib.decompress(data)
+    if kind == 'float':
+        a = array('d')
+        a.fromstring(data)
+        return a.tolist()
+    return json.loads(data)
+
+def write_scenario(store_file, scenario, tables):
+    """Save the tables for one scenario, replacing any that were stored for it before.
+    tables is a list of (table_name, headings, rows) tuples."""
+    con = connect(store_file)
+    try:
+        con.execute("BEGIN IMMEDIATE;")
+        try:
+            con.execute("DELETE FROM chunks WHERE scenario=?;", (scenario,))
+            for (table_name, headings, rows) in tables:
+                for (position, column_name) in enumerate(headings):
+                    col = [r[position] for r in rows]
+                    for (chunk, start) in enumerate(xrange(0, max(len(col), 1), chunk_rows)):
+                        part = col[start:start+chunk_rows]
+                        (kind, data) = encode(part)
+                        con.execute(
+                            "INSERT INTO chunks VALUES (?, ?, ?, ?, ?, ?, ?, ?);",
+                            (scenario, table_name, position, column_name, chunk, kind, len(part),
+                                sqlite3.Binary(data))
+                        )
+            con.execute("INSERT OR REPLACE INTO scenarios VALUES (?, ?);", (scenario, time.time()))
+            con.execute("COMMIT;")
+        except:
+            con.execute("ROLLBACK;")
+            raise
+    finally:
+        con.close()
+
+def list_scenarios(store_file):
+    """Return the names of the scenarios in the store, in the order they were written."""
+    con = connect(store_file)
+    try:
+        return [r[0] for r in con.execute("SELECT scenario FROM scenarios ORDER BY written;")]
+    finally:
+        con.close()
+
+def list_tables(store_file, scenario=None):
+    """Return the names of the tables in the store (optionally, only for one scenario)."""
+    con = connect(store_file)
+    try:
+        if scenario is None:
+            rows = con.execute("SELECT DISTINCT table_name FROM chunks ORDER BY table_name;")
+        else:
+            rows = con.execute(
+                "SELECT DISTINCT table_name FROM chunks WHERE scenario=? ORDER BY table_name;", (scenario,))
+        return [r[0] for r in rows]
+    finally:
+        con.close()
+
+def read_table(store_file, table_name, scenarios=None):
+    """Return (headings, rows) for one table, with the scenario name as the first column
+    (unless the table already has a scenario column, like the summary table).
+    If scenarios is specified, only those scenarios are included. Scenarios with
+    different columns (e.g., different technologies built) are combined, with None
+    for columns that a scenario doesn't have."""
+    con = connect(store_file)
+    try:
+        order = {s: i for (i, s) in enumerate(
+            r[0] for r in con.execute("SELECT scenario FROM scenarios ORDER BY written;"))}
+        columns = {}        # scenario -> {position: (column_name, values)}
+        for (scenario, position, column_name, kind, data) in con.execute("""
+            SELECT scenario, position, column_name, kind, data FROM chunks
+            WHERE table_name=? ORDER BY scenario, position, chunk;
+        """, (table_name,)):
+            if scenarios is not None and scenario not in scenarios:
+                continue
+            col = columns.setdefault(scenario, {}).setdefault(position, (column_name, []))
+            col[1].extend(decode(kind, data))
+    finally:
+        con.close()
+
+    headings = []
+    for s in sorted(columns, key=lambda s: order.get(s)):
+        for p in sorted(columns[s]):
+            if columns[s][p][0] not in headings:
+                headings.append(columns[s][p][0])
+    # tables that have their own scenario column don't get a second one
+    prefix = "scenario" not in headings
+    rows = []
+    for s in sorted(columns, key=lambda s: order.get(s)):
+        cols = {name: values for (name, values) in columns[s].values()}
+        n_rows = max(len(v) for v in cols.values())
+        empty = [None] * n_rows
+        rows.extend(
+            ((s,) if prefix else ()) + r for r in zip(*[cols.get(h, empty) for h in headings])
+        )
+    return ((["scenario"] if prefix else []) + headings, rows)
+
+def read_dataframe(store_file, table_name, scenarios=None):
+    """Return one table as a pandas DataFrame (requires pandas)."""
+    import pandas
+    (headings, rows) = read_table(store_file, table_name, scenarios)
+    return pandas.DataFrame.from_records(rows, columns=headings)
+
+def export_table(store_file, table_name, output_file, scenarios=None):
+    """Write one table for all scenarios as a single tab-separated file."""
+    (headings, rows) = read_table(store_file, table_name, scenarios)
+    with open(output_file, 'wb') as f:
+        w = csv.writer(f, delimiter='\t', lineterminator='\n')
+        w.writerow(headings)
+        w.writerows(rows)
+
+if __name__ == '__main__':
+    if len(sys.argv) != 4:
+        print "usage: python results_store.py <store_file> <table_name> <output_file>"
+        sys.exit(1)
+    export_table(*sys.argv[1:])
@@ -1,7 +1,11 @@
 #!/usr/bin/env python
 
-import sys, os, time
+import sys, os, time, fcntl, itertools
 import pdb, traceback
+import multiprocessing, inspect
+import numpy as np
+from collections import OrderedDict
+from contextlib import contextmanager
 
 from pyomo.environ import *
 from pyomo.opt import SolverFactory, SolverStatus, TerminationCondition
@@ -30,6 +34,7 @@ from util import tic, toc, log, get
 from scenarios import parser
 
 add_relative_path('.') # components for this particular study
+import job_queue, solve_cache, input_loader, profiling, results_arrays, output_writer, results_store
 
 # add_relative_path('..', 'pumped_hydro') # components reused from the pumped_hydro study
 
@@ -54,6 +59,17 @@ if solver == "cplex":
     opt.options['advance'] = 2
     #opt.options['threads'] = 1
 
+# start each cplex solve from the basis found by the previous one (the dr_shares sweep, the 
+# smoothing pass and later scenarios that reuse the same model instance only change a few 
+# bounds, parameters and the objective); the basis is passed to and from cplex in the 
+# sstatus suffix, which cplex uses because of the 'advance' option above
+warm_start = True
+
+# give the variables and constraints their model names in the problem file sent to the solver;
+# these are only needed to read the solver's own files (e.g., with keepfiles=True), and
+# generating them takes a significant share of the time spent writing each problem
+symbolic_solver_labels = False
+
 # define global variables for convenient access in interactive session
 switch_model = None
 switch_instance = None
@@ -62,6 +78,48 @@ results = None
 # global variable for location of results files
 output_dir = None
 
+# keep parsed copies of the .tab input files in <inputs_dir>/.cache (see input_loader.py)
+cache_inputs = True
+# number of processes to use for parsing .tab files that aren't in the cache yet
+input_workers = min(4, multiprocessing.cpu_count())
+
+# format and write output files in a background thread while the next model is solved
+# (see output_writer.py)
+background_output = True
+
+# how to save the output tables: 'tsv' (a separate file for each table and scenario),
+# 'columnar' (all tables for all scenarios in one compressed file, results_store_file in the
+# outputs directory; see results_store.py) or 'both'; this can also be set with --output_backend
+output_backend = 'tsv'
+results_store_file = 'results.sqlite'
+
+# output tables written by write_results() for each output profile (chosen per scenario with
+# --output_profile); the batch summary (summary_all_scenarios.tsv) is always written
+output_profiles = {
+    'summary_only': ['summary'],
+    'capacity': [
+        'summary', 'capacity_by_technology', 'capacity_by_energy_source', 'cost_breakdown', 'rfm_activate'
+    ],
+    'full_dispatch': [
+        'summary', 'energy_sources', 
+        'capacity_by_technology', 'capacity_by_energy_source', 'cost_breakdown', 'rfm_activate'
+    ],
+}
+
+# model templates that have been built in this process, indexed by (modules, inputs_dir);
+# scenarios that differ only in the settings applied by apply_scenario_settings() reuse these
+model_templates = OrderedDict()
+# maximum number of templates to keep at once (each one holds a full model instance)
+max_model_templates = 1
+
+# command-line options that control how the scenarios are run, rather than what
+# goes into them; these are removed from the scenario arguments before calling solve()
+runner_options = ['workers', 'job_queue', 'output_backend']
+
+# solve() arguments that don't affect the results, so they are left out of the solve cache key
+# (the contents of the inputs directory are identified by checksums instead)
+non_cache_args = ['inputs_dir', 'inputs_subdir', 'outputs_dir', 'scenario_name', 'tag', 'use_cache']
+
 def main():
     # only called if solve.py is executed from a command line
     # (not called by 'import solve')
@@ -74,18 +132,80 @@ def main():
     parser.add_argument('--ev_flat', action='store_true', default=None) 
     # Note: ev_flat has to have None as default, otherwise it's always considered to be set 
     # True or False on the command line and that overrides the scenario definitions.
+    parser.add_argument('--use_cache', action='store_true', default=None)
+    parser.add_argument('--output_profile', type=str, choices=sorted(output_profiles.keys()))
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--job_queue', type=str)
+    parser.add_argument('--output_backend', type=str, choices=['tsv', 'columnar', 'both'])
     
     cmd_line_args = scenarios.cmd_line_args()
+    if cmd_line_args.get('output_backend') is not None:
+        global output_backend
+        output_backend = cmd_line_args['output_backend']
+    workers = cmd_line_args.get('workers')
+    queue_file = cmd_line_args.get('job_queue')
+    status_dir = cmd_line_args.get('outputs_dir', 'outputs')
 
     required_scenarios = scenarios.get_required_scenario_names()
 
-    if len(required_scenarios) > 0:
-        # user specified some specific scenarios to run
+    if queue_file is not None:
+        # use the shared SQLite job queue instead of completed_scenarios.txt
+        con = job_queue.connect(queue_file)
+        # explicitly requested scenarios are rerun even if they have been run before
+        for s in (required_scenarios if len(required_scenarios) > 0 else standard_scenario_names()):
+            args = solve_args(scenarios.get_scenario_args(s))
+            job_queue.add_job(
+                con, append_tag(s, args.get("tag")), args, requeue=len(required_scenarios) > 0
+            )
+        if workers is not None:
+            status = run_scenarios([], workers, status_dir=status_dir, queue_file=queue_file)
+            if any(exit_code != 0 for (s, exit_code, secs) in status):
+                sys.exit(1)
+        else:
+            while True:
+                job = job_queue.claim_next_job(con)
+                if job is None:
+                    if job_queue.unfinished_jobs(con) == 0:
+                        break
+                    # scenarios running in other processes may be returned to the queue
+                    # if their leases expire, so check again later
+                    time.sleep(job_queue.poll_seconds)
+                    continue
+                (s, args) = job
+                print 'running scenario {s}'.format(s=s)
+                print 'arguments: {}'.format(args)
+                with job_queue.running_job(queue_file, s):
+                    solve(**args)
+                    # make sure the outputs were written before marking the job as done
+                    output_writer.flush()
+    elif workers is not None:
+        # claim all the scenarios up front, then farm them out to a pool of worker processes
+        scenario_list = []
+        if len(required_scenarios) > 0:
+            for s in required_scenarios:
+                scenarios.report_completed_scenario(s)
+                scenario_list.append(scenarios.get_scenario_args(s))
+        else:
+            while True:
+                s = scenarios.start_next_standard_scenario()
+                if s is None:
+                    break
+                scenario_list.append(s)
+        status = run_scenarios([solve_args(s) for s in scenario_list], workers, status_dir=status_dir)
+        if any(exit_code != 0 for (s, exit_code, secs) in status):
+            sys.exit(1)
+    elif len(required_scenarios) > 0:
+        # user specified some specific scenarios to run;
+        # scenarios that can share a model template are run one after another
+        # (groups are run in the order they first appear in the list)
+        groups = OrderedDict()
         for s in required_scenarios:
+            args = solve_args(scenarios.get_scenario_args(s))
+            groups.setdefault(template_group(args), []).append((s, args))
+        scenario_list = [x for g in groups.values() for x in g]
+        for (s, args) in scenario_list:
             # flag that the scenario is running/completed
             scenarios.report_completed_scenario(s)
-            # get the scenario definition, including any changes specified on the command line
-            args = scenarios.get_scenario_args(s)
             # solve the model
             print "\n\n======================================================================="
             print 'running scenario {s}'.format(s=append_tag(s, args["tag"]))
@@ -99,11 +219,121 @@ def main():
             if s is None:
                 break
             else:
+                s = solve_args(s)
                 # solve the model
                 print 'running scenario {s}'.format(s=append_tag(s["scenario_name"], s["tag"]))
                 print 'arguments: {}'.format(s)
                 solve(**s)
 
+    # wait for the last output files to be written
+    output_writer.flush()
+
+def solve_args(args):
+    """Return a copy of the scenario arguments, without the options that only affect the runner."""
+    return {k: v for k, v in args.iteritems() if k not in runner_options}
+
+def standard_scenario_names(scenarios_file='scenarios_to_run.txt'):
+    """Return the names of the standard scenarios listed in scenarios_file."""
+    names = []
+    with open(scenarios_file) as f:
+        for line in f:
+            if line.strip() != '':
+                names.append(parser.parse_known_args(line.split())[0].scenario_name)
+    return names
+
+def solve_and_write(**args):
+    """Solve a scenario and wait until all its outputs have been written
+    (used for scenarios that run in their own process)."""
+    solve(**args)
+    output_writer.flush()
+
+def run_scenarios(scenario_list, workers, status_dir='outputs', queue_file=None):
+    """Solve each scenario in scenario_list (a list of argument dictionaries for solve()) 
+    in its own process, running up to `workers` of them at once. If queue_file is specified,
+    scenarios are claimed from that job queue instead, and their leases are renewed while
+    they run. Each process exits with code 0 if its scenario solved successfully and 
+    non-zero if it failed (negative if it was killed by a signal). Returns a list of 
+    (scenario, exit_code, seconds) tuples, which is also recorded in scenario_status.tsv 
+    in status_dir."""
+    # note: each scenario gets a fresh process (rather than reusing pool workers), so
+    # crashes in the solver or pyomo can't take down the rest of the batch, and memory
+    # is returned to the system after each scenario.
+    if not os.path.isdir(status_dir):
+        os.makedirs(status_dir)
+    status_file = os.path.join(status_dir, "scenario_status.tsv")
+    with locked_file(status_file):
+        if not os.path.isfile(status_file):
+            util.create_table(
+                output_file=status_file,
+                headings=("scenario", "status", "exit_code", "seconds")
+            )
+
+    if queue_file is None:
+        pending = [(append_tag(a["scenario_name"], a.get("tag")), a) for a in scenario_list]
+        next_scenario = lambda: pending.pop(0) if pending else None
+    else:
+        # this process holds the leases for all the scenarios it runs
+        con = job_queue.connect(queue_file)
+        next_scenario = lambda: job_queue.claim_next_job(con)
+        last_heartbeat = time.time()
+
+    running = []    # (scenario name, process, start time)
+    status = []
+    no_more_scenarios = False
+    next_poll = 0
+    while running or not no_more_scenarios:
+        while not no_more_scenarios and len(running) < workers and time.time() >= next_poll:
+            job = next_scenario()
+            if job is None:
+                if queue_file is None or job_queue.unfinished_jobs(con) == 0:
+                    no_more_scenarios = True
+                else:
+                    # scenarios running here or in other processes may be returned to the 
+                    # queue if their leases expire, so keep checking until all are finished
+                    next_poll = time.time() + job_queue.poll_seconds
+                break
+            (name, args) = job
+            log('starting scenario {s} in a new process\n'.format(s=name))
+            proc = multiprocessing.Process(target=solve_and_write, kwargs=args, name=name)
+            proc.start()
+            running.append((name, proc, time.time()))
+        time.sleep(1)
+        if queue_file is not None and time.time() - last_heartbeat > job_queue.heartbeat_seconds:
+            for (name, proc, start) in running:
+                job_queue.heartbeat(con, name)
+            last_heartbeat = time.time()
+        for (name, proc, start) in list(running):
+            if proc.is_alive():
+                continue
+            proc.join()
+            running.remove((name, proc, start))
+            secs = time.time() - start
+            status.append((name, proc.exitcode, secs))
+            log('scenario {s} {r} (exit code {c}) after {t:.0f}s\n'.format(
+                s=name, r='finished' if proc.exitcode == 0 else 'FAILED', c=proc.exitcode, t=secs
+            ))
+            if queue_file is not None:
+                job_queue.finish_job(
+                    con, name, 
+                    error=None if proc.exitcode == 0 else 'exit code {c}'.format(c=proc.exitcode)
+                )
+            with locked_file(status_file):
+                util.append_table(None, 
+                    output_file=status_file,
+                    values=lambda m: (
+                        name, 'done' if proc.exitcode == 0 else 'failed', proc.exitcode, round(secs, 1)
+                    )
+                )
+
+    print "\n\n======================================================================="
+    print "Scenario status"
+    print "======================================================================="
+    for (name, exit_code, secs) in status:
+        print "{s:40s} {r:8s} exit code {c:4d} {t:10.0f}s".format(
+            s=name, r='done' if exit_code == 0 else 'FAILED', c=exit_code, t=secs
+        )
+    return status
+
 def solve(
     inputs_dir='inputs', inputs_subdir='', outputs_dir='outputs', 
     rps=True, renewables=True, wind=None, central_pv=None,
@@ -115,114 +345,84 @@ def solve(
     fed_subsidies=False,
     biofuel_limit=0.05,
     ev_flat=False,
-    scenario_name=None, tag=None
+    scenario_name=None, tag=None,
+    use_cache=False,
+    output_profile='full_dispatch'
     ):
     # load and solve the model, using specified configuration
     # NOTE: this version solves repeatedly with different DR targets
     global switch_model, switch_instance, results, output_dir
 
+    # save the scenario definition (must be done before any other local variables are created)
+    scenario_args = dict(locals())
+
     # quick fix to use scenario name and (optional) tag
     tag = None if scenario_name is None else append_tag(scenario_name, tag)
+
+    # start a new set of timing and memory measurements for this scenario
+    profiling.reset()
     
+    if output_profile not in output_profiles:
+        raise ValueError("Unknown output profile {p}; use one of {l}.".format(
+            p=output_profile, l=", ".join(sorted(output_profiles.keys()))))
+
     # quick fix for inputs_dir / inputs_subdir
     inputs_dir = os.path.join(inputs_dir, inputs_subdir)
 
-    modules = ['switch_mod', 'fuel_markets', 'fuel_markets_expansion', 'project.no_commit', 
-        'switch_patch', 'rps']
-    modules.append('emission_rules')    # no burning LSFO after 2017 except in cogen plants
-    for m in ['ev', 'pumped_hydro', 'fed_subsidies', 'demand_response_simple', 'hydrogen', 'batteries']:
-        if locals()[m] is True:
-            modules.append(m)
+    modules = scenario_modules(scenario_args)
     if demand_response_simple is not True:
         dr_shares = [0.00]
-    # TODO: treat the 'no_*' modules as standard scenario names 
-    # (i.e., include no_renewables, etc. instead of excluding renewables, etc.)
-    if renewables is False:
-        modules.append('no_renewables')
-    if wind is False:
-        modules.append('no_wind')
-    if central_pv is False:
-        modules.append('no_central_pv')
-    if ev is False:
-        # user asked for no_ev (count transport emissions but don't allow EVs)
-        modules.append('no_ev')
         
     log('using modules: {m}\n'.format(m=modules))
 
-    log("defining model... "); tic()
-    switch_model = define_AbstractModel(*modules)
-    switch_model.iis = Suffix(direction=Suffix.IMPORT)
-    switch_model.dual = Suffix(direction=Suffix.IMPORT)
-    
-    # TODO: put scenario flags into a switch_model.config dictionary and then
-    # do the following model modifications within the respective modules.
-    
-    # force construction of a fixed amount of pumped hydro
-    if ph_mw is not None:
-        print "Forcing construction of {m} MW of pumped hydro.".format(m=ph_mw)
-        switch_model.Build_Pumped_Hydro_MW = Constraint(switch_model.LOAD_ZONES, rule=lambda m, z:
-            m.Pumped_Hydro_Capacity_MW[z, m.PERIODS.last()] == ph_mw
-        )
-    # force construction of pumped hydro only in a certain period
-    if ph_year is not None:
-        print "Allowing construction of pumped hydro only in {p}.".format(p=ph_year)
-        switch_model.Build_Pumped_Hydro_Year = Constraint(
-            switch_model.PH_PROJECTS, switch_model.PERIODS, 
-            rule=lambda m, pr, pe:
-                m.BuildPumpedHydroMW[pr, pe] == 0 if pe != ph_year else Constraint.Skip
-        )
-
-    if biofuel_limit is not None:
-        print "Limiting (bio)fuels to {l}% of electricity production.".format(l=biofuel_limit*100.0)
-        switch_model.rps_fuel_limit = biofuel_limit
-
-    if ev_flat and ev:
-        print "Charging EVs as baseload."
-        switch_model.ChargeEVs_flat = Constraint(
-            switch_model.LOAD_ZONES, switch_model.TIMEPOINTS, 
-            rule=lambda m, z, tp:
-                m.ChargeEVs[z, tp] * m.ts_duration_hrs[m.tp_ts[tp]] == m.ev_mwh_ts[z, m.tp_ts[tp]]
-        )
+    output_dir = outputs_dir    # assign to global variable with slightly different name (ugh)
 
-    # add an alternative objective function that smoothes out various non-cost variables
-    def Smooth_Free_Variables_obj_rule(m):
-        # minimize production (i.e., maximize curtailment / minimize losses)
-        obj = sum(
-            getattr(m, component)[lz, t] 
-                for lz in m.LOAD_ZONES 
-                    for t in m.TIMEPOINTS 
-                        for component in m.LZ_Energy_Components_Produce)
-        # also minimize the magnitude of demand adjustments
-        if hasattr(m, "DemandResponse"):
-            print "Will smooth DemandResponse."
-            obj = obj + sum(m.DemandResponse[z, t]*m.DemandResponse[z, t] for z in m.LOAD_ZONES for t in m.TIMEPOINTS)
-        # also minimize the magnitude of EV charging
-        if hasattr(m, "ChargeEVs"):
-            print "Will smooth EV charging."
-            obj = obj + sum(m.ChargeEVs[z, t]*m.ChargeEVs[z, t] for z in m.LOAD_ZONES for t in m.TIMEPOINTS)
-        return obj
-        
-    switch_model.Smooth_Free_Variables = Objective(rule=Smooth_Free_Variables_obj_rule, sense=minimize)
-    
-    toc()   # done defining model
+    if use_cache and output_backend != 'tsv':
+        # the cache only holds .tsv files, so cached scenarios would be missing from the
+        # columnar results store
+        log("solve cache can only be used with output_backend='tsv'; solving scenario {s}.\n".format(s=tag))
+        use_cache = False
 
-    log("loading model data from {} dir... ".format(inputs_dir)); tic()
-    switch_instance = switch_model.load_inputs(inputs_dir=inputs_dir)
-    toc()
+    if use_cache:
+        # reuse the results from an identical scenario if possible;
+        # names and locations don't affect the results, and the inputs are identified by checksums
+        cache_key = solve_cache.cache_key(modules, 
+            {k: v for k, v in scenario_args.iteritems() if k not in non_cache_args}, 
+            inputs_dir
+        )
+        manifest = solve_cache.lookup(cache_key)
+        if manifest is not None and solve_cache.can_restore(manifest, tag):
+            log("restoring results for scenario {s} from solve cache (entry {k}).\n".format(
+                s=tag, k=cache_key))
+            setup_results_dir()
+            # finish writing the previous scenario first, so the summary rows stay in order
+            output_writer.flush()
+            summary_rows = solve_cache.restore(cache_key, manifest, output_dir, tag)
+            output_file = os.path.join(output_dir, "summary_all_scenarios.tsv")
+            with locked_file(output_file):
+                if not os.path.isfile(output_file):
+                    util.create_table(output_file=output_file, headings=manifest["summary_headings"])
+                for row in summary_rows:
+                    util.append_table(None, output_file=output_file, values=lambda m: row)
+            write_timing(tag)
+            return
+        output_files = []
+        summary_rows = []
 
-    if rps is False:
-        # deactivate the main RPS constraint
-        # (we do this instead of omitting the whole RPS module, 
-        # so we can report RPS-qualified power even if the RPS is not in effect)
-        # NOTE: for now, there's no easy way to pass solver flags into individual modules
-        # which would probably be a cleaner solution
-        switch_instance.RPS_Enforce.deactivate()
-        switch_instance.preprocess()
+    # get a model instance for this combination of modules and inputs (reused from an
+    # earlier scenario if possible), then apply the settings for this scenario
+    with profiling.span("get model template"):
+        template = get_model_template(modules, inputs_dir, biofuel_limit)
+    switch_model = template["model"]
+    switch_instance = template["instance"]
+    with profiling.span("apply scenario settings"):
+        apply_scenario_settings(template, 
+            rps=rps, ph_year=ph_year, ph_mw=ph_mw, biofuel_limit=biofuel_limit, ev_flat=ev_flat
+        )
 
     # investigate the cost_components_annual elements
     # import pdb; pdb.set_trace()
 
-    output_dir = outputs_dir    # assign to global variable with slightly different name (ugh)
     setup_results_dir()
     create_batch_results_file(switch_instance, scenario=tag)
         
@@ -247,7 +447,9 @@ def solve(
             raise RuntimeError("Infeasible model")
 
 
-        append_batch_results(switch_instance, scenario=tag+'_unsmooth')
+        row = append_batch_results(switch_instance, scenario=tag+'_unsmooth')
+        if use_cache:
+            summary_rows.append(row)
         
         if len(dr_shares) > 1:
             t = ("" if tag is None else str(tag) + '_') + 'dr_share_' + str(dr_share)
@@ -258,7 +460,9 @@ def solve(
             # Freeze all direct-cost variables, and then solve the model against 
             # a smoothing objective instead of a cost objective.
             # (only applied for quadratic solvers, i.e., cplex)
-            write_results(switch_instance, tag=t+'_unsmooth')   # keep pre-smoothing results, in case smoothing crashes
+            files = write_results(switch_instance, tag=t+'_unsmooth', profile=output_profile)   # keep pre-smoothing results, in case smoothing crashes
+            if use_cache:
+                output_files.extend(files)
 
             old_duals = [
                 (z, t, switch_instance.dual[switch_instance.Energy_Balance[z, t]])
@@ -311,17 +515,220 @@ def solve(
                         c=c, d=d
                     )
 
-        append_batch_results(switch_instance, scenario=tag)
+        row = append_batch_results(switch_instance, scenario=tag)
         
         if len(dr_shares) > 1:
             t = ("" if tag is None else str(tag) + '_') + 'dr_share_' + str(dr_share)
         else:
             t = tag
-        write_results(switch_instance, tag=t)
+        files = write_results(switch_instance, tag=t, profile=output_profile)
+        if use_cache:
+            summary_rows.append(row)
+            output_files.extend(files)
 
         # take a look at the biofuel limit
         #import pdb; pdb.set_trace()
 
+    if use_cache:
+        # the output files must be complete before they can be cached
+        output_writer.flush()
+        solve_cache.store(cache_key, tag, output_files, 
+            summary_headers(switch_instance, tag), summary_rows)
+
+    write_timing(tag)
+
+
+def solve_defaults():
+    """Return a dictionary of the default arguments for solve()."""
+    spec = inspect.getargspec(solve)
+    return dict(zip(spec.args[-len(spec.defaults):], spec.defaults))
+
+def scenario_modules(args):
+    """Return the list of modules needed for a scenario, given a dictionary of arguments 
+    for solve() (arguments that aren't specified take their default values)."""
+    args = dict(solve_defaults(), **args)
+    modules = ['switch_mod', 'fuel_markets', 'fuel_markets_expansion', 'project.no_commit', 
+        'switch_patch', 'rps']
+    modules.append('emission_rules')    # no burning LSFO after 2017 except in cogen plants
+    for m in ['ev', 'pumped_hydro', 'fed_subsidies', 'demand_response_simple', 'hydrogen', 'batteries']:
+        if args[m] is True:
+            modules.append(m)
+    # TODO: treat the 'no_*' modules as standard scenario names 
+    # (i.e., include no_renewables, etc. instead of excluding renewables, etc.)
+    if args["renewables"] is False:
+        modules.append('no_renewables')
+    if args["wind"] is False:
+        modules.append('no_wind')
+    if args["central_pv"] is False:
+        modules.append('no_central_pv')
+    if args["ev"] is False:
+        # user asked for no_ev (count transport emissions but don't allow EVs)
+        modules.append('no_ev')
+    return modules
+
+def template_group(args):
+    """Return a key identifying the model template that will be used for a scenario 
+    (used to run scenarios that can share a template one after another)."""
+    args = dict(solve_defaults(), **args)
+    return (
+        tuple(scenario_modules(args)), 
+        os.path.join(args["inputs_dir"], args["inputs_subdir"])
+    )
+
+def get_model_template(modules, inputs_dir, biofuel_limit):
+    """Return a model template for the specified modules and inputs directory, reusing
+    one that was built for an earlier scenario if possible."""
+    key = (tuple(modules), inputs_dir)
+    template = model_templates.get(key)
+    if (
+        template is not None and not template["fuel_limit_mutable"] 
+        and template["biofuel_limit"] != biofuel_limit
+    ):
+        # the biofuel limit is baked into the model, so we need a new one
+        template = None
+    if template is None:
+        # discard old templates to make room (each one holds a full model instance)
+        model_templates.pop(key, None)
+        while len(model_templates) >= max_model_templates:
+            model_templates.popitem(last=False)
+        template = build_model_template(modules, inputs_dir, biofuel_limit)
+        model_templates[key] = template
+    else:
+        log("reusing model instance from an earlier scenario.\n")
+    return template
+
+def build_model_template(modules, inputs_dir, biofuel_limit):
+    """Define the model and load the data for the specified modules and inputs directory.
+    Components for all the optional scenario settings are added to the model (e.g., 
+    Build_Pumped_Hydro_MW and ChargeEVs_flat), and then activated or deactivated 
+    by apply_scenario_settings() for each scenario."""
+
+    with profiling.span("define model"):
+        log("defining model... "); tic()
+        switch_model = define_AbstractModel(*modules)
+        switch_model.iis = Suffix(direction=Suffix.IMPORT)
+        switch_model.dual = Suffix(direction=Suffix.IMPORT)
+        if solver == "cplex" and warm_start:
+            # basis status of each variable and constraint, sent back to cplex in the next solve
+            switch_model.sstatus = Suffix(direction=Suffix.IMPORT_EXPORT, datatype=Suffix.INT)
+    
+        # TODO: put scenario flags into a switch_model.config dictionary and then
+        # do the following model modifications within the respective modules.
+    
+        if 'pumped_hydro' in modules:
+            # force construction of a fixed amount of pumped hydro
+            switch_model.ph_mw_forced = Param(mutable=True, initialize=0.0)
+            switch_model.Build_Pumped_Hydro_MW = Constraint(switch_model.LOAD_ZONES, rule=lambda m, z:
+                m.Pumped_Hydro_Capacity_MW[z, m.PERIODS.last()] == m.ph_mw_forced
+            )
+            # force construction of pumped hydro only in a certain period
+            # (the constraints for the allowed period are deactivated in apply_scenario_settings)
+            switch_model.Build_Pumped_Hydro_Year = Constraint(
+                switch_model.PH_PROJECTS, switch_model.PERIODS, 
+                rule=lambda m, pr, pe: m.BuildPumpedHydroMW[pr, pe] == 0
+            )
+
+        # note: if rps_fuel_limit is a mutable parameter, it is set for each scenario
+        # in apply_scenario_settings; otherwise it has to be set before the model is constructed
+        fuel_limit_mutable = isinstance(getattr(switch_model, 'rps_fuel_limit', None), Param) \
+            and switch_model.rps_fuel_limit._mutable
+        if biofuel_limit is not None and not fuel_limit_mutable:
+            switch_model.rps_fuel_limit = biofuel_limit
+
+        if 'ev' in modules:
+            switch_model.ChargeEVs_flat = Constraint(
+                switch_model.LOAD_ZONES, switch_model.TIMEPOINTS, 
+                rule=lambda m, z, tp:
+                    m.ChargeEVs[z, tp] * m.ts_duration_hrs[m.tp_ts[tp]] == m.ev_mwh_ts[z, m.tp_ts[tp]]
+            )
+
+        # add an alternative objective function that smoothes out various non-cost variables
+        def Smooth_Free_Variables_obj_rule(m):
+            # minimize production (i.e., maximize curtailment / minimize losses)
+            obj = sum(
+                getattr(m, component)[lz, t] 
+                    for lz in m.LOAD_ZONES 
+                        for t in m.TIMEPOINTS 
+                            for component in m.LZ_Energy_Components_Produce)
+            # also minimize the magnitude of demand adjustments
+            if hasattr(m, "DemandResponse"):
+                print "Will smooth DemandResponse."
+                obj = obj + sum(m.DemandResponse[z, t]*m.DemandResponse[z, t] for z in m.LOAD_ZONES for t in m.TIMEPOINTS)
+            # also minimize the magnitude of EV charging
+            if hasattr(m, "ChargeEVs"):
+                print "Will smooth EV charging."
+                obj = obj + sum(m.ChargeEVs[z, t]*m.ChargeEVs[z, t] for z in m.LOAD_ZONES for t in m.TIMEPOINTS)
+            return obj
+        
+        switch_model.Smooth_Free_Variables = Objective(rule=Smooth_Free_Variables_obj_rule, sense=minimize)
+    
+        toc()   # done defining model
+
+    log("loading model data from {} dir... ".format(inputs_dir)); tic()
+    with profiling.span("load inputs"), profiling.component_construction():
+        if cache_inputs:
+            # reuse parsed versions of the .tab files from earlier runs if they haven't changed
+            with input_loader.cached_tab_files(inputs_dir, workers=input_workers):
+                switch_instance = switch_model.load_inputs(inputs_dir=inputs_dir)
+        else:
+            switch_instance = switch_model.load_inputs(inputs_dir=inputs_dir)
+    toc()
+
+    return dict(
+        model=switch_model,
+        instance=switch_instance,
+        biofuel_limit=biofuel_limit,
+        fuel_limit_mutable=fuel_limit_mutable,
+        default_fuel_limit=value(switch_instance.rps_fuel_limit) if fuel_limit_mutable else None,
+    )
+
+def apply_scenario_settings(template, rps, ph_year, ph_mw, biofuel_limit, ev_flat):
+    """Activate, deactivate or set the components in a model template to match 
+    the settings for the current scenario. All settings are reset each time, 
+    so nothing carries over from the previous scenario that used this template."""
+    m = template["instance"]
+
+    if ph_mw is not None:
+        print "Forcing construction of {m} MW of pumped hydro.".format(m=ph_mw)
+    if ph_year is not None:
+        print "Allowing construction of pumped hydro only in {p}.".format(p=ph_year)
+    if (ph_mw is not None or ph_year is not None) and not hasattr(m, "Build_Pumped_Hydro_MW"):
+        raise ValueError("The ph_mw and ph_year settings can only be used with the pumped_hydro module.")
+    if hasattr(m, "Build_Pumped_Hydro_MW"):
+        if ph_mw is None:
+            m.Build_Pumped_Hydro_MW.deactivate()
+        else:
+            m.ph_mw_forced = ph_mw
+            m.Build_Pumped_Hydro_MW.activate()
+        for (pr, pe) in m.Build_Pumped_Hydro_Year:
+            if ph_year is None or pe == ph_year:
+                m.Build_Pumped_Hydro_Year[pr, pe].deactivate()
+            else:
+                m.Build_Pumped_Hydro_Year[pr, pe].activate()
+
+    if biofuel_limit is not None:
+        print "Limiting (bio)fuels to {l}% of electricity production.".format(l=biofuel_limit*100.0)
+    if template["fuel_limit_mutable"]:
+        m.rps_fuel_limit = template["default_fuel_limit"] if biofuel_limit is None else biofuel_limit
+
+    if hasattr(m, "ChargeEVs_flat"):
+        if ev_flat:
+            print "Charging EVs as baseload."
+            m.ChargeEVs_flat.activate()
+        else:
+            m.ChargeEVs_flat.deactivate()
+
+    # deactivate the main RPS constraint if requested
+    # (we do this instead of omitting the whole RPS module, 
+    # so we can report RPS-qualified power even if the RPS is not in effect)
+    # NOTE: for now, there's no easy way to pass solver flags into individual modules
+    # which would probably be a cleaner solution
+    if rps is False:
+        m.RPS_Enforce.deactivate()
+    else:
+        m.RPS_Enforce.activate()
+
+    m.preprocess()
 
 def append_tag(text, tag):
     return text if tag is None or tag == "" else text + "_" + str(tag)
@@ -330,21 +737,24 @@ def _solve(m):
     """Solve instance of switch model, using the specified objective, then load the results"""
 
     tic()
-    results = opt.solve(m, keepfiles=False, tee=True,
-        symbolic_solver_labels=True, suffixes=['dual', 'iis'])
+    with profiling.span("solve"):
+        results = opt.solve(m, keepfiles=False, tee=True,
+            symbolic_solver_labels=symbolic_solver_labels, 
+            suffixes=['dual', 'iis'] + (['sstatus'] if hasattr(m, 'sstatus') else []))
     log("Solver finished; "); toc()
 
     # results.write()
     log("loading solution... "); tic()
-    # Pyomo changed their interface for loading results somewhere 
-    # between 4.0.x and 4.1.x in a way that was not backwards compatible.
-    # Make the code accept either version
-    if hasattr(m, 'solutions'):
-        # Works in Pyomo version 4.1.x
-        m.solutions.load_from(results)
-    else:
-        # Works in Pyomo version 4.0.9682
-        m.load(results)
+    with profiling.span("load solution"):
+        # Pyomo changed their interface for loading results somewhere 
+        # between 4.0.x and 4.1.x in a way that was not backwards compatible.
+        # Make the code accept either version
+        if hasattr(m, 'solutions'):
+            # Works in Pyomo version 4.1.x
+            m.solutions.load_from(results)
+        else:
+            # Works in Pyomo version 4.0.9682
+            m.load(results)
     toc()
     
     return results
@@ -404,26 +814,26 @@ def summary_values(m, scenario):
     # total cost (all periods)
     values.append(m.Minimize_System_Cost.expr)
 
+    # kWh consumed in each timepoint (all load zones), discounted to the base year
+    # (each component is read in one pass; see results_arrays.py)
+    tps = list(m.TIMEPOINTS)
+    discounted_kwh = (
+        results_arrays.component_array(m.bring_timepoint_costs_to_base_year, [tps]) * 1000.0 
+        * sum(results_arrays.component_array(getattr(m, c), [None, tps]) for c in demand_components)
+    )
+    period_pos = results_arrays.positions(list(m.PERIODS))
+    discounted_kwh_by_period = np.bincount(
+        [period_pos[m.tp_period[t]] for t in tps], weights=discounted_kwh, minlength=len(period_pos)
+    )
+
     # NPV of total cost / NPV of kWh generated (equivalent to spreading 
     # all costs uniformly over all generation)
-    values.append(
-        m.Minimize_System_Cost.expr
-        / sum(
-            m.bring_timepoint_costs_to_base_year[t] * 1000.0 *
-            sum(getattr(m, c)[lz, t] for c in demand_components for lz in m.LOAD_ZONES)
-            for t in m.TIMEPOINTS 
-        )
-    )
+    values.append(m.Minimize_System_Cost.expr / float(discounted_kwh.sum()))
             
     #  total cost / kWh generated in each period 
     # (both discounted to today, so the discounting cancels out)
     values.extend([
-        m.SystemCostPerPeriod[p]
-        / sum(
-            m.bring_timepoint_costs_to_base_year[t] * 1000.0 *
-            sum(getattr(m, c)[lz, t] for c in demand_components for lz in m.LOAD_ZONES)
-            for t in m.PERIOD_TPS[p]
-        )
+        m.SystemCostPerPeriod[p] / float(discounted_kwh_by_period[period_pos[p]])
         for p in m.PERIODS
     ])
 
@@ -445,213 +855,298 @@ def summary_values(m, scenario):
 
     return values
     
+@contextmanager
+def locked_file(output_file):
+    """Hold an exclusive lock on output_file (via output_file.lock) while the body runs,
+    so concurrent scenarios can't create or append to the file at the same time."""
+    with open(output_file + '.lock', 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
 def create_batch_results_file(m, scenario=None):
     # create a file to hold batch results, but only if it doesn't already exist
     # (if it exists, we keep it, so multiple threads can write to it as needed)
 
     output_file = os.path.join(output_dir, "summary_all_scenarios.tsv")
-    if not os.path.isfile(output_file):
-        util.create_table(
-            output_file=output_file,
-            headings=summary_headers(m, scenario)
-        )
+    with locked_file(output_file):
+        if not os.path.isfile(output_file):
+            util.create_table(
+                output_file=output_file,
+                headings=summary_headers(m, scenario)
+            )
+
+def write_timing(tag):
+    """Save the timing and memory measurements for the current scenario in the outputs directory."""
+    profiling.write(os.path.join(
+        output_dir, "timing{t}.json".format(t="" if tag is None or tag == "" else "_" + str(tag))
+    ))
 
 def append_batch_results(m, scenario=None):
     # append results to the batch results file
-    util.append_table(m, 
-        output_file=os.path.join(output_dir, "summary_all_scenarios.tsv"), 
-        values=lambda m: summary_values(m, scenario)
-    )
+    # (values are calculated before taking the lock, so other processes aren't kept waiting)
+    output_file = os.path.join(output_dir, "summary_all_scenarios.tsv")
+    row = [value(v) for v in summary_values(m, scenario)]
+    if background_output:
+        output_writer.submit(append_batch_row, output_file, row)
+    else:
+        append_batch_row(output_file, row)
+    return row
 
-def write_results(m, tag=None):
+def append_batch_row(output_file, row):
+    with locked_file(output_file):
+        util.append_table(None, output_file=output_file, values=lambda m: row)
+
+def table_rows(m, *indexes, **kwargs):
+    """Calculate the rows of an output table (the same ones util.write_table would write)."""
+    values = kwargs["values"]
+    return [tuple(value(v) for v in values(m, *x)) for x in itertools.product(*indexes)]
+
+def write_output_table(m, *indexes, **kwargs):
+    """Write an output table via util.write_table. If background_output is True, the rows 
+    are calculated now, but the file is formatted and written by the background writer."""
+    if background_output:
+        rows = table_rows(m, *indexes, **kwargs)
+        kwargs = dict(kwargs, values=lambda m, row: row)
+        output_writer.submit(util.write_table, None, rows, **kwargs)
+    else:
+        util.write_table(m, *indexes, **kwargs)
+
+def write_results(m, tag=None, profile='full_dispatch'):
     scenario = tag
+    # tables to write (others are skipped without calculating their values)
+    tables = set(output_profiles[profile])
     # format the tag to append to file names (if any)
     if tag is not None and tag != "":
         tag = "_"+str(tag)
     else:
         tag = ""
+
+    # keep track of the files written and the table in each, so they can be saved in the solve cache
+    output_files = []
+    # name of the table written to each file (used in the columnar results store)
+    table_names = {}
+    def output_file(name):
+        f = os.path.join(output_dir, name.format(t=tag))
+        table_names[f] = os.path.splitext(name.format(t=""))[0]
+        return f
+
+    # tables to add to the columnar results store, as (table_name, headings, rows)
+    store_tables = []
+
+    # record the time and memory used for each table
+    def write_table(m, *indexes, **kwargs):
+        if table_names[kwargs["output_file"]] not in tables:
+            return
+        with profiling.span("write " + os.path.basename(kwargs["output_file"])):
+            if output_backend in ('columnar', 'both'):
+                # calculate the rows once and use them for both backends
+                rows = table_rows(m, *indexes, **kwargs)
+                store_tables.append((table_names[kwargs["output_file"]], kwargs["headings"], rows))
+                (m, indexes, kwargs) = (None, (rows,), dict(kwargs, values=lambda m, row: row))
+            if output_backend in ('tsv', 'both'):
+                output_files.append((kwargs["output_file"], table_names[kwargs["output_file"]]))
+                write_output_table(m, *indexes, **kwargs)
         
-    util.write_table(m, 
-        output_file=os.path.join(output_dir, "summary{t}.tsv".format(t=tag)), 
+    write_table(m, 
+        output_file=output_file("summary{t}.tsv"), 
         headings=summary_headers(m, scenario),
         values=lambda m: summary_values(m, scenario)
     )
     
     # # write out results
     # util.write_table(m, m.TIMEPOINTS,
-    #     output_file=os.path.join(output_dir, "dispatch{t}.tsv".format(t=tag)),
+    #     output_file=output_file("dispatch{t}.tsv"),
     #     headings=("timepoint_label",)+tuple(m.PROJECTS),
     #     values=lambda m, t: (m.tp_timestamp[t],) + tuple(
     #         get(m.DispatchProj, (p, t), 0.0)
     #         for p in m.PROJECTS
     #     )
     # )
-    avg_ts_scale = float(sum(m.ts_scale_to_year[ts] for ts in m.TIMESERIES))/len(m.TIMESERIES)
-    util.write_table(
-        m, m.LOAD_ZONES, m.TIMEPOINTS,
-        output_file=os.path.join(output_dir, "energy_sources{t}.tsv".format(t=tag)), 
-        headings=
-            ("load_zone", "period", "timepoint_label")
-            +tuple(m.FUELS)
-            +tuple(m.NON_FUEL_ENERGY_SOURCES)
-            +tuple("curtail_"+s for s in m.NON_FUEL_ENERGY_SOURCES)
-            +tuple(m.LZ_Energy_Components_Produce)
-            +tuple(m.LZ_Energy_Components_Consume)
-            +("marginal_cost","peak_day"),
-        values=lambda m, z, t: 
-            (z, m.tp_period[t], m.tp_timestamp[t]) 
-            +tuple(
-                sum(get(m.DispatchProjByFuel, (p, t, f), 0.0) for p in m.PROJECTS_BY_FUEL[f])
-                for f in m.FUELS
-            )
-            +tuple(
-                sum(get(m.DispatchProj, (p, t), 0.0) for p in m.PROJECTS_BY_NON_FUEL_ENERGY_SOURCE[s])
-                for s in m.NON_FUEL_ENERGY_SOURCES
-            )
-            +tuple(
-                sum(
-                    get(m.DispatchUpperLimit, (p, t), 0.0) - get(m.DispatchProj, (p, t), 0.0) 
-                    for p in m.PROJECTS_BY_NON_FUEL_ENERGY_SOURCE[s]
-                )
-                for s in m.NON_FUEL_ENERGY_SOURCES
-            )
-            +tuple(getattr(m, component)[z, t] for component in m.LZ_Energy_Components_Produce)
-            +tuple(getattr(m, component)[z, t] for component in m.LZ_Energy_Components_Consume)
-            +(get(m.dual, m.Energy_Balance[z, t], 0.0)/m.bring_timepoint_costs_to_base_year[t], 
+    if "energy_sources" in tables:
+        avg_ts_scale = float(sum(m.ts_scale_to_year[ts] for ts in m.TIMESERIES))/len(m.TIMESERIES)
+
+        # pull all the values needed for the energy_sources table into arrays, reading each
+        # component once, then calculate the table with array operations (see results_arrays.py)
+        zones, tps = list(m.LOAD_ZONES), list(m.TIMEPOINTS)
+        projects, non_fuel_sources = list(m.PROJECTS), list(m.NON_FUEL_ENERGY_SOURCES)
+        non_fuel_projects = results_arrays.incidence(non_fuel_sources, projects, 
+            ((s, p) for s in non_fuel_sources for p in m.PROJECTS_BY_NON_FUEL_ENERGY_SOURCE[s])
+        )
+        dispatch = results_arrays.component_array(m.DispatchProj, [projects, tps])
+        upper_limit = results_arrays.component_array(m.DispatchUpperLimit, [projects, tps])
+        bring_to_base_year = results_arrays.component_array(m.bring_timepoint_costs_to_base_year, [tps])
+        # note: fuel and energy source totals cover all load zones, as in earlier versions of this table
+        energy_columns = np.hstack([
+            results_arrays.component_array(m.DispatchProjByFuel, [None, tps, list(m.FUELS)]),
+            non_fuel_projects.dot(dispatch).T,
+            non_fuel_projects.dot(upper_limit - dispatch).T,
+        ])
+        zone_columns = np.dstack(
+            [
+                results_arrays.component_array(getattr(m, component), [zones, tps])
+                    for component in list(m.LZ_Energy_Components_Produce) + list(m.LZ_Energy_Components_Consume)
+            ] + [
                 # note: this uses 0.0 if no dual available, i.e., with glpk solver
-            'peak' if m.ts_scale_to_year[m.tp_ts[t]] < avg_ts_scale else 'typical')
-    )
+                results_arrays.dual_array(m, m.Energy_Balance, [zones, tps]) / bring_to_base_year
+            ]
+        )
+        z_pos, t_pos = results_arrays.positions(zones), results_arrays.positions(tps)
+        energy_rows = energy_columns.tolist()
+        zone_rows = [zone_columns[i].tolist() for i in range(len(zones))]
+        write_table(
+            m, m.LOAD_ZONES, m.TIMEPOINTS,
+            output_file=output_file("energy_sources{t}.tsv"), 
+            headings=
+                ("load_zone", "period", "timepoint_label")
+                +tuple(m.FUELS)
+                +tuple(m.NON_FUEL_ENERGY_SOURCES)
+                +tuple("curtail_"+s for s in m.NON_FUEL_ENERGY_SOURCES)
+                +tuple(m.LZ_Energy_Components_Produce)
+                +tuple(m.LZ_Energy_Components_Consume)
+                +("marginal_cost","peak_day"),
+            values=lambda m, z, t: 
+                (z, m.tp_period[t], m.tp_timestamp[t]) 
+                +tuple(energy_rows[t_pos[t]])
+                +tuple(zone_rows[z_pos[z]][t_pos[t]])
+                +('peak' if m.ts_scale_to_year[m.tp_ts[t]] < avg_ts_scale else 'typical',)
+        )
     
     # installed capacity information
-    g_energy_source = lambda t: '/'.join(sorted(m.G_FUELS[t])) if m.g_uses_fuel[t] else m.g_energy_source[t]
-    built_proj = tuple(set(
-        pr for pe in m.PERIODS for pr in m.PROJECTS if value(m.ProjCapacity[pr, pe]) > 0.001
-    ))
-    built_tech = tuple(set(m.proj_gen_tech[p] for p in built_proj))
-    built_energy_source = tuple(set(g_energy_source(t) for t in built_tech))
-    # print "missing energy_source: "+str([t for t in built_tech if g_energy_source(t)==''])
+    if tables.intersection(['capacity_by_technology', 'capacity_by_energy_source', 'cost_breakdown']):
+        g_energy_source = lambda t: '/'.join(sorted(m.G_FUELS[t])) if m.g_uses_fuel[t] else m.g_energy_source[t]
+        proj = results_arrays.project_attributes(m, g_energy_source)
+        capacity = {(pr, pe): value(m.ProjCapacity[pr, pe]) for pr in m.PROJECTS for pe in m.PERIODS}
+        built_proj = tuple(set(pr for ((pr, pe), c) in capacity.iteritems() if c > 0.001))
+        built_tech = tuple(set(proj[pr]["tech"] for pr in built_proj))
+        built_energy_source = tuple(set(proj[pr]["energy_source"] for pr in built_proj))
 
-    battery_capacity_mw = lambda m, z, pe: (
-        (m.Battery_Capacity[z, pe] * m.battery_max_discharge / m.battery_min_discharge_time)
-            if hasattr(m, "Battery_Capacity") else 0.0
-    )
-    
-    util.write_table(m, m.LOAD_ZONES, m.PERIODS, 
-        output_file=os.path.join(output_dir, "capacity_by_technology{t}.tsv".format(t=tag)),
-        headings=("load_zone", "period") + built_tech + ("hydro", "batteries"),
-        values=lambda m, z, pe: (z, pe,) + tuple(
-            sum(m.ProjCapacity[pr, pe] for pr in built_proj 
-                if m.proj_gen_tech[pr] == t and m.proj_load_zone[pr] == z)
-            for t in built_tech
-        ) + (
-            m.Pumped_Hydro_Capacity_MW[z, pe] if hasattr(m, "Pumped_Hydro_Capacity_MW") else 0,
-            battery_capacity_mw(m, z, pe) 
+        # totals for built projects by (load zone, period, technology or energy source),
+        # each calculated in a single pass
+        built_proj_periods = [(pr, pe) for pr in built_proj for pe in m.PERIODS]
+        # note: build years before the study (existing plants) aren't reported
+        built_proj_buildyears = [
+            (pr, bld_yr) for pr in built_proj for bld_yr in proj[pr]["build_years"] if bld_yr in m.PERIODS
+        ]
+        by_tech = lambda (pr, pe): (proj[pr]["zone"], pe, proj[pr]["tech"])
+        by_energy_source = lambda (pr, pe): (proj[pr]["zone"], pe, proj[pr]["energy_source"])
+        capacity_by_tech = results_arrays.group_sum(built_proj_periods, key=by_tech, 
+            value=lambda pr_pe: capacity[pr_pe])
+        capacity_by_energy_source = results_arrays.group_sum(built_proj_periods, key=by_energy_source, 
+            value=lambda pr_pe: capacity[pr_pe])
+        build_by_tech = results_arrays.group_sum(built_proj_buildyears, key=by_tech, 
+            value=lambda (pr, pe): value(m.BuildProj[pr, pe]))
+        overnight_cost_by_tech = results_arrays.group_sum(built_proj_buildyears, key=by_tech, 
+            value=lambda (pr, pe): 
+                value(m.BuildProj[pr, pe]) * (m.proj_overnight_cost[pr, pe] + m.proj_connect_cost_per_mw[pr])
         )
-    )
-    util.write_table(m, m.LOAD_ZONES, m.PERIODS, 
-        output_file=os.path.join(output_dir, "capacity_by_energy_source{t}.tsv".format(t=tag)),
-        headings=("load_zone", "period") + built_energy_source + ("hydro", "batteries"),
-        values=lambda m, z, pe: (z, pe,) + tuple(
-            sum(m.ProjCapacity[pr, pe] for pr in built_proj 
-                if g_energy_source(m.proj_gen_tech[pr]) == s and m.proj_load_zone[pr] == z)
-            for s in built_energy_source
-        ) + (
-            m.Pumped_Hydro_Capacity_MW[z, pe] if hasattr(m, "Pumped_Hydro_Capacity_MW") else 0,
-            battery_capacity_mw(m, z, pe)
+        # print "missing energy_source: "+str([t for t in built_tech if g_energy_source(t)==''])
+
+        battery_capacity_mw = lambda m, z, pe: (
+            (m.Battery_Capacity[z, pe] * m.battery_max_discharge / m.battery_min_discharge_time)
+                if hasattr(m, "Battery_Capacity") else 0.0
         )
-    )
-    
-    def cost_breakdown_details(m, z, pe):
-        values = [z, pe]
-        # capacity built, conventional plants
-        values += [
-            sum(
-                m.BuildProj[pr, pe] 
-                    for pr in built_proj 
-                        if m.proj_gen_tech[pr] == t and m.proj_load_zone[pr] == z and (pr, pe) in m.BuildProj
+
+        write_table(m, m.LOAD_ZONES, m.PERIODS, 
+            output_file=output_file("capacity_by_technology{t}.tsv"),
+            headings=("load_zone", "period") + built_tech + ("hydro", "batteries"),
+            values=lambda m, z, pe: (z, pe,) + tuple(
+                capacity_by_tech.get((z, pe, t), 0) for t in built_tech
+            ) + (
+                m.Pumped_Hydro_Capacity_MW[z, pe] if hasattr(m, "Pumped_Hydro_Capacity_MW") else 0,
+                battery_capacity_mw(m, z, pe) 
             )
-            for t in built_tech
-        ]
-        # capacity built, batteries, MW and MWh
-        if hasattr(m, "BuildBattery"):
-            values.extend([
-                m.BuildBattery[z, pe]/m.battery_min_discharge_time, 
-                m.BuildBattery[z, pe]
-            ])
-        else:
-            values.append([0.0, 0.0])
-        # capacity built, hydro
-        values.append(
-            sum(
-                m.BuildPumpedHydroMW[pr, pe] 
-                    for pr in m.PH_PROJECTS if m.ph_load_zone[pr]==z
-            ) if hasattr(m, "BuildPumpedHydroMW") else 0.0,
         )
-        # capacity built, hydrogen
-        if hasattr(m, "BuildElectrolyzerMW"):
-            values.extend([
-                m.BuildElectrolyzerMW[z, pe],
-                m.BuildLiquifierKgPerHour[z, pe],
-                m.BuildLiquidHydrogenTankKg[z, pe],
-                m.BuildFuelCellMW[z, pe]
-            ])
-        else:
-            values.extend([0.0, 0.0, 0.0, 0.0])
-        
-        # capital investments
-        # regular projects
-        values += [
-            sum(
-                m.BuildProj[pr, pe] * (m.proj_overnight_cost[pr, pe] + m.proj_connect_cost_per_mw[pr])
-                    for pr in built_proj 
-                        if m.proj_gen_tech[pr] == t and m.proj_load_zone[pr] == z and (pr, pe) in m.PROJECT_BUILDYEARS
+        write_table(m, m.LOAD_ZONES, m.PERIODS, 
+            output_file=output_file("capacity_by_energy_source{t}.tsv"),
+            headings=("load_zone", "period") + built_energy_source + ("hydro", "batteries"),
+            values=lambda m, z, pe: (z, pe,) + tuple(
+                capacity_by_energy_source.get((z, pe, s), 0) for s in built_energy_source
+            ) + (
+                m.Pumped_Hydro_Capacity_MW[z, pe] if hasattr(m, "Pumped_Hydro_Capacity_MW") else 0,
+                battery_capacity_mw(m, z, pe)
             )
-            for t in built_tech
-        ]
-        # batteries
-        values.append(m.BuildBattery[z, pe] * m.battery_capital_cost_per_mwh_capacity if hasattr(m, "BuildBattery") else 0.0)
-        # hydro
-        values.append(
-            sum(
-                m.BuildPumpedHydroMW[pr, pe] * m.ph_capital_cost_per_mw[pr]
-                    for pr in m.PH_PROJECTS if m.ph_load_zone[pr]==z
-            ) if hasattr(m, "BuildPumpedHydroMW") else 0.0,
         )
-        # hydrogen
-        if hasattr(m, "BuildElectrolyzerMW"):
-            values.extend([
-                m.BuildElectrolyzerMW[z, pe] * m.hydrogen_electrolyzer_capital_cost_per_mw,
-                m.BuildLiquifierKgPerHour[z, pe] * m.hydrogen_liquifier_capital_cost_per_kg_per_hour,
-                m.BuildLiquidHydrogenTankKg[z, pe] * m.liquid_hydrogen_tank_capital_cost_per_kg,
-                m.BuildFuelCellMW[z, pe] * m.hydrogen_fuel_cell_capital_cost_per_mw
-            ])
-        else:
-            values.extend([0.0, 0.0, 0.0, 0.0])
-
-        # _annual_ fuel expenditures
-        if hasattr(m, "REGIONAL_FUEL_MARKET"):
-            values.extend([
-                sum(m.FuelConsumptionByTier[rfm_st] * m.rfm_supply_tier_cost[rfm_st] for rfm_st in m.RFM_P_SUPPLY_TIERS[rfm, pe])
-                    for rfm in m.REGIONAL_FUEL_MARKET
-            ])
-        # costs to expand fuel markets (this could later be disaggregated by market and tier)
-        if hasattr(m, "RFM_Fixed_Costs_Annual"):
-            values.append(m.RFM_Fixed_Costs_Annual[pe])
-        # TODO: add similar code for fuel_costs module instead of fuel_markets module
-        
-        return values
-        
-    util.write_table(m, m.LOAD_ZONES, m.PERIODS, 
-        output_file=os.path.join(output_dir, "cost_breakdown{t}.tsv".format(t=tag)),
-        headings=("load_zone", "period") + tuple(t+"_mw_added" for t in built_tech)
-            + ("batteries_mw_added", "batteries_mwh_added", "hydro_mw_added") 
-            + ("h2_electrolyzer_mw_added", "h2_liquifier_kg_per_hour_added", "liquid_h2_tank_kg_added", "fuel_cell_mw_added")
-            + tuple(t+"_overnight_cost" for t in built_tech) + ("batteries_overnight_cost", "hydro_overnight_cost")
-            + ("h2_electrolyzer_overnight_cost", "h2_liquifier_overnight_cost", "liquid_h2_tank_overnight_cost", "fuel_cell_overnight_cost")
-            + (tuple(rfm+"_annual_cost" for rfm in m.REGIONAL_FUEL_MARKET) if hasattr(m, "REGIONAL_FUEL_MARKET") else ())
-            + (("fuel_market_expansion_annual_cost",) if hasattr(m, "RFM_Fixed_Costs_Annual") else ()),
-        values=cost_breakdown_details
-    )
+
+        def cost_breakdown_details(m, z, pe):
+            values = [z, pe]
+            # capacity built, conventional plants
+            values += [build_by_tech.get((z, pe, t), 0) for t in built_tech]
+            # capacity built, batteries, MW and MWh
+            if hasattr(m, "BuildBattery"):
+                values.extend([
+                    m.BuildBattery[z, pe]/m.battery_min_discharge_time, 
+                    m.BuildBattery[z, pe]
+                ])
+            else:
+                values.append([0.0, 0.0])
+            # capacity built, hydro
+            values.append(
+                sum(
+                    m.BuildPumpedHydroMW[pr, pe] 
+                        for pr in m.PH_PROJECTS if m.ph_load_zone[pr]==z
+                ) if hasattr(m, "BuildPumpedHydroMW") else 0.0,
+            )
+            # capacity built, hydrogen
+            if hasattr(m, "BuildElectrolyzerMW"):
+                values.extend([
+                    m.BuildElectrolyzerMW[z, pe],
+                    m.BuildLiquifierKgPerHour[z, pe],
+                    m.BuildLiquidHydrogenTankKg[z, pe],
+                    m.BuildFuelCellMW[z, pe]
+                ])
+            else:
+                values.extend([0.0, 0.0, 0.0, 0.0])
+
+            # capital investments
+            # regular projects
+            values += [overnight_cost_by_tech.get((z, pe, t), 0) for t in built_tech]
+            # batteries
+            values.append(m.BuildBattery[z, pe] * m.battery_capital_cost_per_mwh_capacity if hasattr(m, "BuildBattery") else 0.0)
+            # hydro
+            values.append(
+                sum(
+                    m.BuildPumpedHydroMW[pr, pe] * m.ph_capital_cost_per_mw[pr]
+                        for pr in m.PH_PROJECTS if m.ph_load_zone[pr]==z
+                ) if hasattr(m, "BuildPumpedHydroMW") else 0.0,
+            )
+            # hydrogen
+            if hasattr(m, "BuildElectrolyzerMW"):
+                values.extend([
+                    m.BuildElectrolyzerMW[z, pe] * m.hydrogen_electrolyzer_capital_cost_per_mw,
+                    m.BuildLiquifierKgPerHour[z, pe] * m.hydrogen_liquifier_capital_cost_per_kg_per_hour,
+                    m.BuildLiquidHydrogenTankKg[z, pe] * m.liquid_hydrogen_tank_capital_cost_per_kg,
+                    m.BuildFuelCellMW[z, pe] * m.hydrogen_fuel_cell_capital_cost_per_mw
+                ])
+            else:
+                values.extend([0.0, 0.0, 0.0, 0.0])
+
+            # _annual_ fuel expenditures
+            if hasattr(m, "REGIONAL_FUEL_MARKET"):
+                values.extend([
+                    sum(m.FuelConsumptionByTier[rfm_st] * m.rfm_supply_tier_cost[rfm_st] for rfm_st in m.RFM_P_SUPPLY_TIERS[rfm, pe])
+                        for rfm in m.REGIONAL_FUEL_MARKET
+                ])
+            # costs to expand fuel markets (this could later be disaggregated by market and tier)
+            if hasattr(m, "RFM_Fixed_Costs_Annual"):
+                values.append(m.RFM_Fixed_Costs_Annual[pe])
+            # TODO: add similar code for fuel_costs module instead of fuel_markets module
+
+            return values
+
+        write_table(m, m.LOAD_ZONES, m.PERIODS, 
+            output_file=output_file("cost_breakdown{t}.tsv"),
+            headings=("load_zone", "period") + tuple(t+"_mw_added" for t in built_tech)
+                + ("batteries_mw_added", "batteries_mwh_added", "hydro_mw_added") 
+                + ("h2_electrolyzer_mw_added", "h2_liquifier_kg_per_hour_added", "liquid_h2_tank_kg_added", "fuel_cell_mw_added")
+                + tuple(t+"_overnight_cost" for t in built_tech) + ("batteries_overnight_cost", "hydro_overnight_cost")
+                + ("h2_electrolyzer_overnight_cost", "h2_liquifier_overnight_cost", "liquid_h2_tank_overnight_cost", "fuel_cell_overnight_cost")
+                + (tuple(rfm+"_annual_cost" for rfm in m.REGIONAL_FUEL_MARKET) if hasattr(m, "REGIONAL_FUEL_MARKET") else ())
+                + (("fuel_market_expansion_annual_cost",) if hasattr(m, "RFM_Fixed_Costs_Annual") else ()),
+            values=cost_breakdown_details
+        )
     
     # util.write_table(m, m.PERIODS,
     #     output_file=os.path.join(output_dir, "capacity{t}.tsv".format(t=t)),
@@ -661,12 +1156,21 @@ def write_results(m, tag=None):
 
 
     if hasattr(m, 'RFMSupplyTierActivate'):
-        util.write_table(m, m.RFM_SUPPLY_TIERS,
-            output_file=os.path.join(output_dir, "rfm_activate{t}.tsv".format(t=tag)), 
+        write_table(m, m.RFM_SUPPLY_TIERS,
+            output_file=output_file("rfm_activate{t}.tsv"), 
             headings=("market", "period", "tier", "activate"),
             values=lambda m, r, p, st: (r, p, st, m.RFMSupplyTierActivate[r, p, st])
         )
     
+    if len(store_tables) > 0:
+        # all the tables for this scenario are added to the store in one transaction
+        store_file = os.path.join(output_dir, results_store_file)
+        if background_output:
+            output_writer.submit(results_store.write_scenario, store_file, scenario or "", store_tables)
+        else:
+            results_store.write_scenario(store_file, scenario or "", store_tables)
+
+    return output_files
 
     # import pprint
     # b=[(pr, pe, value(m.BuildProj[pr, pe]), m.proj_gen_tech[pr], m.proj_overnight_cost[pr, pe]) for (pr, pe) in m.BuildProj if value(m.BuildProj[pr, pe]) > 0]
@@ -0,0 +1,130 @@
+"""
+Content-addressed cache of solved scenarios.
+
+Each solved scenario is stored under a key calculated from the list of modules
+used, the scenario arguments passed to solve() (biofuel_limit, ph_mw, dr_shares,
+ev_flat, etc.) and checksums of every file in the inputs directory. If a later
+scenario has the same key, its output tables and summary rows are restored from
+the cache instead of building and solving the model again.
+
+Note: the key does not include the source code of switch or the study modules,
+so the cache directory should be cleared after making changes to the model code.
+"""
+
+import os, json, shutil, hashlib
+
+# default location for cached results
+cache_dir = 'solve_cache'
+
+# increment this to invalidate all previously cached results
+cache_version = 2
+
+def file_checksums(inputs_dir):
+    """Return a dictionary of sha1 checksums for all the files in inputs_dir
+    (subdirectories and hidden files are ignored)."""
+    checksums = {}
+    for f in sorted(os.listdir(inputs_dir)):
+        path = os.path.join(inputs_dir, f)
+        if f.startswith('.') or not os.path.isfile(path):
+            continue
+        h = hashlib.sha1()
+        with open(path, 'rb') as fh:
+            for block in iter(lambda: fh.read(1 << 20), b''):
+                h.update(block)
+        checksums[f] = h.hexdigest()
+    return checksums
+
+def cache_key(modules, args, inputs_dir):
+    """Calculate a key identifying the results that would be produced by solving a model
+    with the specified modules and scenario arguments, using the data in inputs_dir."""
+    key_data = dict(
+        version=cache_version,
+        modules=list(modules),
+        args=args,
+        inputs=file_checksums(inputs_dir),
+    )
+    # note: sort_keys makes the key independent of dictionary ordering
+    return hashlib.sha1(json.dumps(key_data, sort_keys=True)).hexdigest()
+
+def _entry_dir(key):
+    return os.path.join(cache_dir, key)
+
+def lookup(key):
+    """Return the manifest for a cached scenario, or None if the key isn't in the cache."""
+    manifest_file = os.path.join(_entry_dir(key), 'manifest.json')
+    if not os.path.isfile(manifest_file):
+        return None
+    with open(manifest_file) as f:
+        return json.load(f)
+
+def _tagged(name, tag, suffix):
+    """Return a file name in the form used by write_results, e.g., <table>_<tag><suffix>."""
+    return name + ('' if tag is None or tag == '' else '_' + str(tag)) + suffix
+
+def _suffix(text, prefix):
+    """Return the part of text that follows prefix (which it must start with)."""
+    if not text.startswith(prefix):
+        raise ValueError("{t} does not start with {p}".format(t=text, p=prefix))
+    return text[len(prefix):]
+
+def store(key, tag, output_files, summary_headings, summary_rows):
+    """Save output_files (a list of (file, table_name) tuples) and the rows that were added 
+    to the batch summary file for a scenario that was solved with the specified tag.
+    The manifest records the table name and suffix of each file (e.g., '_unsmooth.tsv')
+    and the suffix of each scenario name, so they can be renamed exactly for a new tag."""
+    scenario = '' if tag is None else str(tag)
+    entry_dir = _entry_dir(key)
+    tmp_dir = entry_dir + '.tmp{p}'.format(p=os.getpid())
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    files = []
+    for (f, table) in output_files:
+        name = os.path.basename(f)
+        shutil.copy2(f, os.path.join(tmp_dir, name))
+        files.append(dict(file=name, table=table, suffix=_suffix(name, _tagged(table, tag, ''))))
+    with open(os.path.join(tmp_dir, 'manifest.json'), 'w') as mf:
+        json.dump(dict(
+            tag=tag,
+            files=files,
+            summary_headings=list(summary_headings),
+            summary_rows=[
+                dict(suffix=_suffix(row[0], scenario), values=list(row[1:])) for row in summary_rows
+            ],
+        ), mf)
+    # move the whole entry into place at once, so other processes never see a partial entry
+    if os.path.exists(entry_dir):
+        shutil.rmtree(tmp_dir)
+    else:
+        os.rename(tmp_dir, entry_dir)
+
+def can_restore(manifest, tag):
+    """Cached files are named with the original scenario's tag; they can be renamed for
+    a new tag unless the original scenario had no tag."""
+    return manifest["tag"] == tag or manifest["tag"] not in (None, '')
+
+def restore(key, manifest, outputs_dir, tag):
+    """Copy cached output files into outputs_dir, renamed for the specified tag.
+    Returns the cached summary rows, with the scenario names updated for the new tag."""
+    scenario = '' if tag is None else str(tag)
+    for entry in manifest["files"]:
+        src = os.path.join(_entry_dir(key), entry["file"])
+        dest = os.path.join(outputs_dir, _tagged(entry["table"], tag, entry["suffix"]))
+        if entry["table"] == 'summary' and manifest["tag"] != tag:
+            # the summary table in summary_<tag><extra>.tsv has <tag><extra> as the scenario name
+            ext = os.path.splitext(entry["file"])[1]
+            _restore_summary(src, dest, scenario + entry["suffix"][:len(entry["suffix"])-len(ext)])
+        else:
+            shutil.copy2(src, dest)
+    return [[scenario + row["suffix"]] + row["values"] for row in manifest["summary_rows"]]
+
+def _restore_summary(src, dest, scenario):
+    """Copy a summary table, replacing the scenario name in the first column."""
+    with open(src, 'rb') as fin, open(dest, 'wb') as fout:
+        # headings
+        fout.write(fin.readline())
+        for line in fin:
+            text = line.rstrip('\r\n')
+            cols = text.split('\t', 1)
+            cols[0] = scenario
+            fout.write('\t'.join(cols) + line[len(text):])